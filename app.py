@@ -1,15 +1,31 @@
 import os
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, render_template, request, flash, redirect, session, g,
+                   url_for, abort, jsonify, Response)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError, PendingRollbackError
 from functools import wraps
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Like, Request
+from database import read_replica
+from models import (db, connect_db, User, Message, Like, Request, Follow, Block,
+                    TimelineEntry)
+from passwords import PasswordHasherBusy
+from pagination import paginate_messages, paginate_users
+from current_user import (load_current_user, forget_current_user,
+                          CurrentUserGone)
+from visibility import resolve_message, resolve_user
+from search import search_users, autocomplete_usernames
+from metrics import metrics
+from notifications import notifications, NotificationBrokerFull
+from fragments import init_fragment_cache
+from http_cache import conditional, init_http_cache
 
 CURR_USER_KEY = "curr_user"
 ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'unknown password')
+TRENDING_LIMIT = 20
+TRENDING_MAX_LIMIT = 100
 
 app = Flask(__name__)
 
@@ -19,12 +35,84 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL_FIXED', 'postgresql:///warbler'))
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Connection pool of each database, per worker process. Pre-ping drops
+# connections the server has closed before handing them out. Applied to
+# every engine except SQLite ones, which don't pool (see database.py).
+app.config['DATABASE_POOL_OPTIONS'] = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    'pool_pre_ping': True,
+}
+
+# Optional read replica for @read_replica views, and how long a user's
+# reads stay on the primary after they write (see database.py).
+if os.environ.get('REPLICA_DATABASE_URL'):
+    app.config['SQLALCHEMY_BINDS'] = {
+        'replica': os.environ['REPLICA_DATABASE_URL']}
+app.config['REPLICA_STICKY_SECONDS'] = int(
+    os.environ.get('REPLICA_STICKY_SECONDS', 5))
+
+# Longest a single SQL statement may run during a request (PostgreSQL).
+app.config['STATEMENT_TIMEOUT_MS'] = int(
+    os.environ.get('STATEMENT_TIMEOUT_MS', 5000))
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Password hashing: bcrypt work factor, and how many hashes may run or wait
+# at once before logins are turned away (see passwords.py).
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 16))
+app.config['PASSWORD_HASH_WAIT'] = float(
+    os.environ.get('PASSWORD_HASH_WAIT', 1.0))
 # toolbar = DebugToolbarExtension(app)
 
+# Run queued jobs (timeline delivery, account deletion...) inside the
+# request instead of in worker.py; handy in development without a worker.
+app.config['JOBS_INLINE'] = os.environ.get('JOBS_INLINE', '').lower() in (
+    '1', 'true', 'yes')
+
+# Statements one request may repeat before it's logged as a likely N+1.
+app.config['N_PLUS_ONE_THRESHOLD'] = int(
+    os.environ.get('N_PLUS_ONE_THRESHOLD', 10))
+
+# Serve the per-route totals at /metrics (see metrics.py). Off by default;
+# when on, only requests from this host, or sending METRICS_TOKEN as a
+# bearer token if that's set, may read them.
+app.config['METRICS_ENABLED'] = os.environ.get(
+    'METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# Rendered user/message cards kept for reuse (see fragments.py).
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_URL'] = os.environ.get('FRAGMENT_CACHE_URL')
+
+# Live notification streams each worker process may hold open (see
+# notifications.py). Each one holds a request thread for as long as it's
+# open, so by default they may take at most half of the worker's threads
+# (WEB_THREADS, passed to gunicorn's --threads in the Procfile).
+app.config['WEB_THREADS'] = int(os.environ.get('WEB_THREADS', 16))
+app.config['NOTIFY_MAX_CONNECTIONS'] = int(
+    os.environ.get('NOTIFY_MAX_CONNECTIONS',
+                   max(1, app.config['WEB_THREADS'] // 2)))
+
+# Trending messages: seconds for a like's weight to halve, and how often
+# each process rebuilds its scores from the database (see trending.py).
+app.config['TRENDING_HALF_LIFE'] = int(
+    os.environ.get('TRENDING_HALF_LIFE', 3600))
+app.config['TRENDING_MAX_AGE'] = int(os.environ.get('TRENDING_MAX_AGE', 60))
+
 connect_db(app)
+metrics.init_app(app)
+notifications.init_app(app)
+init_fragment_cache(app)
+init_http_cache(app)
 
 
 ##############################################################################
@@ -53,8 +141,8 @@ def check_correct_user_or_admin(func):
 def check_if_blocked(func):
     @wraps(func)
     def wrap(*args, **kwargs):
-        user = User.query.get_or_404(kwargs.get("user_id"))
-        if g.user.is_blocked(user) and not g.user.is_admin:
+        blocked_by = Block.sets_for(g.user.id)[1]
+        if kwargs.get("user_id") in blocked_by and not g.user.is_admin:
             flash("This user has blocked you.", "warning")
             return redirect("/users")
         return func(*args, **kwargs)
@@ -63,16 +151,89 @@ def check_if_blocked(func):
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
-    g.form = MessageForm()
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a CurrentUser: its basic columns come from a short-lived
+    cache, and the full row is only loaded if a view needs it.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_current_user(session[CURR_USER_KEY])
+
+        # the account was deleted since this session logged in
+        if g.user is None:
+            do_logout()
 
     else:
         g.user = None
 
 
+@app.errorhandler(CurrentUserGone)
+def current_user_gone(e):
+    """The session user was deleted while their columns were still cached:
+    log them out instead of failing halfway through the view."""
+
+    db.session.rollback()
+    do_logout()
+    g.user = None
+    forget_current_user(e.args[0])
+    return redirect("/login")
+
+
+@app.context_processor
+def add_message_form():
+    """Let templates build the new-message form only when they show it."""
+
+    def message_form():
+        if "message_form" not in g:
+            g.message_form = MessageForm()
+        return g.message_form
+
+    return {"message_form": message_form}
+
+
+def next_page_url(**cursor):
+    """URL of the next page of the current listing.
+
+    Keeps the current query string (e.g. a search) and swaps in the new
+    cursor. Returns None when there is no next page.
+    """
+
+    if not any(cursor.values()):
+        return None
+
+    args = request.args.to_dict()
+    args.pop("partial", None)
+    args.update(cursor)
+    return url_for(request.endpoint, **request.view_args, **args)
+
+
+def render_listing(template, page_template, **context):
+    """Render a paginated listing.
+
+    "Load more" requests (?partial=1) only get the next page of cards,
+    rendered with `page_template`; everything else gets the full page.
+
+    If the listing has messages, the current user's likes for them are
+    loaded up front so message cards don't each run a query.
+    """
+
+    if g.user and context.get("messages"):
+        g.user.load_likes(context["messages"])
+
+    if request.args.get("partial"):
+        return render_template(page_template, **context)
+    return render_template(template, **context)
+
+
+def too_busy_to_hash(template, form):
+    """Response for when the password hasher has no free slots."""
+
+    flash("Too many sign-in attempts right now. Please try again shortly.",
+          "danger")
+    return render_template(template, form=form), 503
+
+
 def do_login(user):
     """Log in user."""
 
@@ -112,6 +273,9 @@ def signup():
             db.session.add(user)
             db.session.commit()
 
+        except PasswordHasherBusy:
+            return too_busy_to_hash('users/signup.html', form)
+
         except IntegrityError:
             flash("Username or email already exists!", 'danger')
             return render_template('users/signup.html', form=form)
@@ -131,10 +295,15 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        try:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
+        except PasswordHasherBusy:
+            return too_busy_to_hash('users/login.html', form)
     
         if user:
+            # saves the password hash if authenticate() upgraded it
+            db.session.commit()
             do_login(user)
             flash(f"Welcome, {user.username}!", "success")
             return redirect("/")
@@ -156,73 +325,159 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@read_replica
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio and
+    location; search shows the best matches only, without paging.
     """
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
+    if search:
+        users = search_users(search, viewer_id=g.user and g.user.id)
+        after = None
     else:
-        users = User.query.filter(User.username.ilike(f"%{search}%")).all()
+        query = User.query
+        if g.user:
+            query = query.filter(Block.not_between(g.user.id, User.id))
+        users, after = paginate_users(query,
+                                      request.args.get('after'),
+                                      User.id)
+
+    if g.user:
+        g.user.load_relations()
+
+    return render_listing('users/index.html', 'users/page.html',
+                          users=users,
+                          next_url=next_page_url(after=after))
+
+
+@app.route('/api/users')
+def api_search_users():
+    """Search users as JSON: {"users": [{id, username, image_url, bio}]}.
+
+    Takes the same 'q' param as /users.
+    """
+
+    users = search_users(request.args.get('q', ''),
+                         viewer_id=g.user and g.user.id)
+
+    return jsonify(users=[
+        {
+            "id": user.id,
+            "username": user.username,
+            "image_url": user.image_url,
+            "bio": user.bio,
+        }
+        for user in users
+    ])
 
-    return render_template('users/index.html', users=users)
+
+@app.route('/api/users/autocomplete')
+def api_autocomplete_usernames():
+    """Usernames starting with 'q', as JSON: {"usernames": [...]}."""
+
+    return jsonify(usernames=autocomplete_usernames(request.args.get('q', '')))
 
 
 @app.route('/users/<int:user_id>')
+@read_replica
 @check_authenticated
-@check_if_blocked
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    visibility = resolve_user(user_id)
+    if visibility.blocked_by and not visibility.is_admin:
+        flash("This user has blocked you.", "warning")
+        return redirect("/users")
+
+    user = visibility.user
+    can_view = visibility.can_view
+
+    # The ETag is checked before the messages themselves are loaded, so
+    # it's made from the page's message ids (read from the profile index
+    # alone) and which of them the viewer has liked.
+    page, before = [], None
+    if can_view:
+        page, before = paginate_messages(
+            (db.session
+             .query(Message.id, Message.timestamp)
+             .filter(Message.user_id == user.id)),
+            request.args.get('before'),
+            Message.timestamp,
+            Message.id)
+    message_ids = [row.id for row in page]
+
+    g.user.load_likes(page)
+    liked = [row.id for row in page if g.user.has_liked(row)]
+
+    def render():
+        messages = (Message
+                    .query
+                    .options(db.joinedload(Message.user))
+                    .filter(Message.id.in_(message_ids))
+                    .order_by(Message.timestamp.desc(), Message.id.desc())
+                    .all())
 
-    is_self = g.user and user.id == g.user.id
-    is_following = g.user and g.user.is_following(user)
-    is_public = not user.is_private
-    is_admin = g.user.is_admin
-    can_view = is_self or is_following or is_public or is_admin
+        return render_listing('users/show.html', 'messages/page.html',
+                              user=user,
+                              visibility=visibility,
+                              can_view=can_view,
+                              messages=messages,
+                              next_url=next_page_url(before=before))
+
+    return conditional(
+        render,
+        user.id, user.updated_at, user.is_private,
+        user.message_count, user.following_count, user.follower_count,
+        user.liked_count, can_view, message_ids, before,
+        visibility.relations, liked)
 
-    return render_template('users/show.html', user=user, can_view=can_view)
-    
 
 @app.route('/users/<int:user_id>/following')
 @check_authenticated
-@check_if_blocked
 def show_following(user_id):
     """Show list of people this user is following."""
 
-    user = User.query.get_or_404(user_id)
-    is_self = g.user and user.id == g.user.id
-    is_following = g.user and g.user.is_following(user)
-    is_public = user.is_private
-
-    if not is_self and not is_following and not is_public:
+    visibility = resolve_user(user_id)
+    if not visibility.can_view:
         flash("Not authorized!", "danger")
         return redirect(f"/users/{user_id}")
 
-    return render_template('users/following.html', user=user)
+    user = visibility.user
+
+    following = (User.query
+                 .join(Follow, Follow.followee == User.id)
+                 .filter(Follow.follower == user.id,
+                         Block.not_between(g.user.id, User.id)))
+
+    g.user.load_relations()
+    return render_template('users/following.html', user=user,
+                           visibility=visibility, users=following)
 
 
 @app.route('/users/<int:user_id>/followers')
 @check_authenticated
-@check_if_blocked
 def users_followers(user_id):
     """Show list of followers of this user."""
-    user = User.query.get_or_404(user_id)
-
-    is_self = g.user and user.id == g.user.id
-    is_following = g.user and g.user.is_following(user)
-    is_public = user.is_private
 
-    if not is_self and not is_following and not is_public:
+    visibility = resolve_user(user_id)
+    if not visibility.can_view:
         flash("Not authorized!", "danger")
         return redirect(f"/users/{user_id}")
 
-    return render_template('users/followers.html', user=user)
+    user = visibility.user
+
+    followers = (User.query
+                 .join(Follow, Follow.follower == User.id)
+                 .filter(Follow.followee == user.id,
+                         Block.not_between(g.user.id, User.id)))
+
+    g.user.load_relations()
+    return render_template('users/followers.html', user=user,
+                           visibility=visibility, users=followers)
 
 
 @app.route('/users/follow/<int:user_id>', methods=['POST'])
@@ -237,11 +492,15 @@ def add_follow(user_id):
         return redirect(request.referrer)
     
     if followed_user.is_private:
-        g.user.following_requests.append(followed_user)
-        db.session.commit()
+        if g.user.request_follow(followed_user):
+            db.session.commit()
+            notifications.publish(followed_user.id, 'follow_request',
+                                  id=g.user.id,
+                                  username=g.user.username,
+                                  image_url=g.user.image_url)
         return redirect(request.referrer)
 
-    g.user.following.append(followed_user)
+    g.user.follow(followed_user)
     db.session.commit()
 
     return redirect(request.referrer)
@@ -252,8 +511,8 @@ def add_follow(user_id):
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    followed_user = User.query.get_or_404(follow_id)
+    g.user.unfollow(followed_user)
     db.session.commit()
 
     return redirect(request.referrer)
@@ -269,7 +528,12 @@ def profile(user_id):
     form = UserEditForm(obj=user)
 
     if form.validate_on_submit():
-        is_authorized = User.authenticate(g.user.username, form.password.data)
+        try:
+            is_authorized = User.authenticate(g.user.username,
+                                              form.password.data)
+        except PasswordHasherBusy:
+            return too_busy_to_hash('/users/edit.html', form)
+
         if is_authorized:
             user.username = form.username.data
             user.email = form.email.data
@@ -278,8 +542,10 @@ def profile(user_id):
             user.bio = form.bio.data
             user.is_private = form.is_private.data
             user.is_admin = form.admin_password.data == ADMIN_PASSWORD
+            user.updated_at = datetime.utcnow()
 
             db.session.commit()
+            forget_current_user(user.id)
 
             return redirect(f"/users/{user.id}")
         else:
@@ -295,14 +561,16 @@ def delete_user(user_id):
     """Delete user."""
     user = User.query.get_or_404(user_id)
 
+    user.schedule_deletion()
+
     if g.user.id == user.id:
         do_logout()
-        db.session.delete(user)
         db.session.commit()
+        forget_current_user(user_id)
         return redirect("/signup")
     else:
-        db.session.delete(user)
         db.session.commit()
+        forget_current_user(user_id)
         return redirect("/users")
 
 
@@ -312,6 +580,28 @@ def show_notifications():
     return render_template('users/notifications.html', user=g.user)  
 
 
+@app.route('/notifications/stream')
+def stream_notifications():
+    """Server-sent events with the user's new notifications."""
+
+    if not g.user:
+        abort(401)
+
+    try:
+        subscription = notifications.subscribe(g.user.id)
+    except NotificationBrokerFull:
+        return Response("Too many open streams", status=503,
+                        headers={'Retry-After': '30'})
+
+    response = Response(subscription.stream(),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+    # the stream unsubscribes when it ends, but only if it was started
+    response.call_on_close(lambda: notifications.unsubscribe(subscription))
+    return response
+
+
 @app.route('/users/block/<int:user_id>', methods=["POST"])
 @check_authenticated
 def block_user(user_id):
@@ -319,16 +609,7 @@ def block_user(user_id):
     if g.user == user:
         return redirect('/')
 
-    g.user.blocked_users.append(user)
-    if g.user.is_followed_by(user):
-        g.user.followers.remove(user)
-    if g.user.is_following(user):
-        g.user.following.remove(user)
-    if g.user.is_pending_follow(user):
-        g.user.following_requests.remove(user)
-    if g.user.has_pending_follower(user):
-        g.user.follower_requests.remove(user)
-    
+    g.user.block(user)
     db.session.commit()
     return redirect(f"/users/{user_id}")
 
@@ -337,7 +618,7 @@ def block_user(user_id):
 @check_authenticated
 def unblock_user(user_id):
     user = User.query.get_or_404(user_id)
-    g.user.blocked_users.remove(user)
+    g.user.unblock(user)
     db.session.commit()
     return redirect(f"/users/{user_id}")
 
@@ -356,28 +637,26 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        g.user.post_message(form.text.data)
         db.session.commit()
 
         return redirect(f"/")
 
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@read_replica
 def messages_show(message_id):
     """Show a message."""
-    msg = Message.query.get(message_id)
 
-    is_self = g.user and msg.user.id == g.user.id
-    is_following = g.user and g.user.is_following(msg.user)
-    is_public = msg.user.is_private
-    is_admin = g.user.is_admin
-
-    if not is_self and not is_following and not is_public and not is_admin:
+    msg, visibility = resolve_message(message_id)
+    if not visibility.can_view:
         flash("Not authorized!", "danger")
         return redirect('/')
 
-    return render_template('messages/show.html', message=msg)
+    return conditional(
+        lambda: render_template('messages/show.html', message=msg,
+                                visibility=visibility),
+        msg.id, msg.user.updated_at, visibility.relations)
 
 
 @app.route('/users/<int:user_id>/messages/<int:message_id>/delete', methods=["POST"])
@@ -386,9 +665,9 @@ def messages_show(message_id):
 def messages_destroy(user_id, message_id):
     """Delete a message."""
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.get_or_404(message_id)
 
-    db.session.delete(msg)
+    msg.destroy()
     db.session.commit()
 
     return redirect("/")
@@ -405,39 +684,119 @@ def add_liked_message(message_id):
         flash("You can't like your own messages!", "danger")
         return redirect("/")
 
-    if message in g.user.liked_messages:
-        g.user.liked_messages.remove(message)
-        db.session.commit()
+    if g.user.has_liked(message):
+        g.user.unlike(message)
     else:
-        g.user.liked_messages.append(message)
-        db.session.commit()
+        g.user.like(message)
+    db.session.commit()
     
     return redirect('/')
 
 
-@app.route('/users/<int:user_id>/likes')
-def show_liked_messages(user_id):
-    user = User.query.get_or_404(user_id)
+@app.route('/api/messages/<int:message_id>/like', methods=['PUT', 'DELETE'])
+def api_like_message(message_id):
+    """Like (PUT) or unlike (DELETE) a message.
+
+    Both are idempotent, so a repeated or racing click can't double count.
+    Returns JSON: {"liked": bool, "likes": number of likes on the message}.
+    """
 
-    is_self = g.user and user.id == g.user.id
-    is_following = g.user and g.user.is_following(user)
-    is_public = user.is_private
-    is_admin = g.user.is_admin
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
 
-    if not is_self and not is_following and not is_public and not is_admin:
+    message = Message.query.get(message_id)
+    if message is None:
+        return jsonify(error="No such message."), 404
+    if message.user_id == g.user.id:
+        return jsonify(error="You can't like your own messages!"), 403
+
+    likes = message.like_count
+    if request.method == 'PUT':
+        likes += g.user.like(message)
+    else:
+        likes -= g.user.unlike(message)
+    db.session.commit()
+
+    return jsonify(liked=request.method == 'PUT', likes=likes)
+
+
+@app.route('/users/<int:user_id>/likes')
+def show_liked_messages(user_id):
+    visibility = resolve_user(user_id)
+    if not visibility.can_view:
         flash("Not authorized!", "danger")
         return redirect('/')
 
-    return render_template('users/likes.html', user=user)   
+    user = visibility.user
+
+    query = (Message
+             .query
+             .options(db.joinedload(Message.user))
+             .join(Like)
+             .filter(Like.user_id == user.id))
+    if g.user:
+        query = query.filter(Block.not_between(g.user.id, Message.user_id))
+
+    messages, before = paginate_messages(
+        query,
+        request.args.get('before'),
+        Message.timestamp,
+        Message.id)
+
+    return render_listing('users/likes.html', 'messages/page.html',
+                          user=user,
+                          visibility=visibility,
+                          messages=messages,
+                          next_url=next_page_url(before=before))
+
+
+@app.route('/trending')
+@check_authenticated
+def show_trending():
+    """Page of the most liked messages lately."""
+
+    trending = Message.trending(TRENDING_LIMIT, g.user.id)
+    messages = [message for message, _ in trending]
+
+    return render_listing('trending.html', 'messages/page.html',
+                          messages=messages)
+
+
+@app.route('/api/trending')
+def api_trending():
+    """The most liked messages lately, best first, as JSON:
+    {"messages": [{id, text, timestamp, user: {id, username}, likes, score}]}.
+
+    Takes a 'limit' param (default 20, at most 100). "score" is the
+    message's likes, each decayed by its age.
+    """
+
+    limit = min(request.args.get('limit', TRENDING_LIMIT, type=int),
+                TRENDING_MAX_LIMIT)
+    trending = Message.trending(max(limit, 1), g.user and g.user.id)
+
+    return jsonify(messages=[
+        {
+            "id": message.id,
+            "text": message.text,
+            "timestamp": message.timestamp.isoformat(),
+            "user": {
+                "id": message.user.id,
+                "username": message.user.username,
+            },
+            "likes": message.like_count,
+            "score": round(score, 3),
+        }
+        for message, score in trending
+    ])
 
 
 @app.route("/requests/accept/<int:sender_id>", methods=["POST"])
 @check_authenticated
 def accept_follow_request(sender_id):
     sender = User.query.get_or_404(sender_id)
-    req = Request.query.get_or_404([sender_id, g.user.id])
-    g.user.followers.append(sender)
-    db.session.delete(req)
+    if not g.user.accept_follow_request(sender):
+        abort(404)
     db.session.commit()
     return redirect("/notifications")
 
@@ -453,30 +812,67 @@ def delete_follow_request(sender_id):
     return redirect("/notifications")
 
 
+@app.route("/requests", methods=["POST"])
+@check_authenticated
+def handle_follow_requests():
+    """Accept or decline the checked follow requests, or all of them
+    (with 'all' in the query string or form)."""
+
+    if request.values.get('all'):
+        sender_ids = None
+    else:
+        sender_ids = [int(sender_id)
+                      for sender_id in request.form.getlist('sender_ids')
+                      if sender_id.isdigit()]
+        if not sender_ids:
+            flash("No requests selected.", "warning")
+            return redirect("/notifications")
+
+    action = request.form.get('action')
+    if action == 'accept':
+        count = len(g.user.accept_follow_requests(sender_ids))
+        flash(f"Accepted {count} follow request(s).", "success")
+    elif action == 'decline':
+        count = g.user.decline_follow_requests(sender_ids)
+        flash(f"Declined {count} follow request(s).", "success")
+    else:
+        abort(400)
+
+    db.session.commit()
+    return redirect("/notifications")
+
+
 
 ##############################################################################
 # Homepage and error pages
 
 
 @app.route('/')
+@read_replica
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
-        user_id_to_display = [user.id for user in g.user.following]
-        user_id_to_display.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(user_id_to_display))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages)
+        messages, before = paginate_messages(
+            (TimelineEntry
+             .messages_for(g.user.id)
+             .options(db.joinedload(Message.user))),
+            request.args.get('before'),
+            TimelineEntry.timestamp,
+            TimelineEntry.message_id)
+
+        suggestions = []
+        if not request.args.get('partial'):
+            suggestions = g.user.suggested_follows()
+
+        return render_listing('home.html', 'messages/page.html',
+                              messages=messages,
+                              suggestions=suggestions,
+                              next_url=next_page_url(before=before))
 
     else:
         return render_template('home-anon.html')
@@ -491,10 +887,15 @@ def homepage():
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers to responses without a cache policy.
+
+    Pages that can be revalidated and static files set their own (see
+    http_cache.py).
+    """
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if 'Cache-Control' not in response.headers:
+        response.cache_control.no_store = True
     return response
 
 
@@ -0,0 +1,454 @@
+"""Benchmark Warbler's main routes.
+
+Seeds a dataset through the models, then requests each route many times
+and reports throughput, p50/p95/p99 latency and SQL queries per request
+(read from the Server-Timing header, see metrics.py). Results are saved as
+JSON named after the current git commit, so runs can be compared:
+
+    # in-process, with the Flask test client, on a scratch SQLite file
+    python benchmark.py --database sqlite:////tmp/warbler-bench.db
+
+    # against a local gunicorn using the same database
+    python benchmark.py --database postgresql:///warbler_bench --seed-only
+    DATABASE_URL_FIXED=postgresql:///warbler_bench gunicorn app:app -w 4 &
+    python benchmark.py --database postgresql:///warbler_bench --no-seed \\
+        --url http://127.0.0.1:8000 --concurrency 8
+
+    python benchmark.py --compare bench_results/<older commit>.json
+
+Nothing here uses the network beyond the local server given with --url.
+"""
+
+import argparse
+import http.cookiejar
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from random import Random
+
+# app.py's default database, i.e. the development one; never seeded
+APP_DATABASE = 'postgresql:///warbler'
+
+BENCH_USERNAME = 'benchmark'
+BENCH_PASSWORD = 'benchmark'
+
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+def report(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+##############################################################################
+# Dataset
+
+def seed_dataset(args):
+    """Fill a fresh database with users, messages, follows and likes.
+
+    User 1 is the benchmark user, who follows `args.follows` others, like
+    everyone else does. Returns nothing; the ids the routes need are found
+    again by `pick_targets`, so a seeded database can be reused.
+    """
+
+    from models import (db, bcrypt, User, Message, Follow, Like,
+                        TimelineEntry, recount_counters)
+
+    rng = Random(args.seed)
+    now = datetime.utcnow()
+
+    db.drop_all()
+    db.create_all()
+
+    # a cheap hash: logging in is not what's being measured
+    password = bcrypt.generate_password_hash(BENCH_PASSWORD, 4).decode('UTF-8')
+    users = [User(username=BENCH_USERNAME if i == 0 else f"user{i}",
+                  email=f"user{i}@bench.test",
+                  password=password)
+             for i in range(args.users)]
+    db.session.add_all(users)
+    db.session.commit()
+    user_ids = [user.id for user in users]
+    report(f"users: {len(user_ids):,}")
+
+    messages = [
+        dict(text=f"Benchmark message {i} from user {user_id}",
+             user_id=user_id,
+             timestamp=now - timedelta(minutes=rng.randrange(60 * 24 * 365)))
+        for user_id in user_ids
+        for i in range(args.messages)
+    ]
+    db.session.bulk_insert_mappings(Message, messages)
+    db.session.commit()
+    report(f"messages: {len(messages):,}")
+
+    follows = [
+        dict(follower=user_id, followee=followee)
+        for user_id in user_ids
+        for followee in sample_others(rng, user_ids, user_id, args.follows)
+    ]
+    db.session.bulk_insert_mappings(Follow, follows)
+    db.session.commit()
+    report(f"follows: {len(follows):,}")
+
+    message_ids = [id for (id,) in db.session.query(Message.id)]
+    likes = [
+        dict(user_id=user_id, message_id=message_id)
+        for user_id in user_ids
+        for message_id in rng.sample(message_ids,
+                                     min(args.likes, len(message_ids)))
+    ]
+    db.session.bulk_insert_mappings(Like, likes)
+    db.session.commit()
+    report(f"likes: {len(likes):,}")
+
+    for _ in TimelineEntry.rebuild_batches():
+        db.session.commit()
+    recount_counters()
+    db.session.commit()
+
+
+def sample_others(rng, user_ids, user_id, count):
+    """Up to `count` random ids from `user_ids`, leaving out `user_id`."""
+
+    picked = rng.sample(user_ids, min(count + 1, len(user_ids)))
+    return [id for id in picked if id != user_id][:count]
+
+
+def pick_targets():
+    """Find the ids the benchmarked routes point at.
+
+    The profile, message and like toggle use someone the benchmark user
+    follows; the follow toggle uses someone they don't.
+    """
+
+    from models import db, User, Message, Follow
+
+    viewer = User.query.filter_by(username=BENCH_USERNAME).one()
+    followed = (db.session
+                .query(Follow.followee)
+                .filter(Follow.follower == viewer.id)
+                .order_by(Follow.followee)
+                .limit(1)
+                .scalar())
+    stranger = (User.query
+                .filter(User.id != viewer.id,
+                        ~User.followers.any(User.id == viewer.id),
+                        User.is_private.isnot(True))
+                .order_by(User.id)
+                .first())
+    message = (Message.query
+               .filter_by(user_id=followed)
+               .order_by(Message.id)
+               .first())
+
+    if followed is None or stranger is None or message is None:
+        sys.exit("The dataset needs follows, non-followed users and "
+                 "messages; seed with more --users/--follows/--messages.")
+
+    return dict(viewer=viewer.id, followed=followed,
+                stranger=stranger.id, message=message.id)
+
+
+def benchmark_routes(targets):
+    """(name, [(method, path), ...]) for each benchmarked route.
+
+    Routes that change data alternate between their two directions, so the
+    dataset ends up as it started.
+    """
+
+    viewer = targets['viewer']
+    followed = targets['followed']
+    stranger = targets['stranger']
+    message = targets['message']
+
+    return [
+        ('home', [('GET', '/')]),
+        ('users', [('GET', '/users')]),
+        ('profile', [('GET', f'/users/{followed}')]),
+        ('followers', [('GET', f'/users/{followed}/followers')]),
+        ('likes', [('GET', f'/users/{viewer}/likes')]),
+        ('message', [('GET', f'/messages/{message}')]),
+        ('like_toggle', [('PUT', f'/api/messages/{message}/like'),
+                         ('DELETE', f'/api/messages/{message}/like')]),
+        ('follow_toggle', [('POST', f'/users/follow/{stranger}'),
+                           ('POST', f'/users/stop-following/{stranger}')]),
+    ]
+
+
+##############################################################################
+# Clients: each has request(method, path) -> (status, Server-Timing)
+
+class TestClient:
+    """Runs requests in this process with Flask's test client."""
+
+    def __init__(self, viewer_id):
+        from app import app, CURR_USER_KEY
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = viewer_id
+
+    def request(self, method, path):
+        resp = self.client.open(path, method=method,
+                                headers={'Referer': '/'})
+        return resp.status_code, resp.headers.get('Server-Timing', '')
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPClient:
+    """Sends requests to a running server, logged in as the bench user."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            _NoRedirect)
+        self.login()
+
+    def login(self):
+        html = self.opener.open(f"{self.base_url}/login").read().decode()
+        token = CSRF_TOKEN.search(html)
+        data = dict(username=BENCH_USERNAME, password=BENCH_PASSWORD)
+        if token:
+            data['csrf_token'] = token.group(1)
+
+        status, _ = self.request('POST', '/login', data)
+        if status != 302:
+            sys.exit(f"Couldn't log in to {self.base_url} ({status}); was it "
+                     f"started on the benchmark database?")
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data or {}).encode()
+        req = urllib.request.Request(
+            self.base_url + path, method=method,
+            data=body if method == 'POST' else None,
+            headers={'Referer': f"{self.base_url}/"})
+        try:
+            with self.opener.open(req) as resp:
+                resp.read()
+                return resp.status, resp.headers.get('Server-Timing', '')
+        except urllib.error.HTTPError as err:
+            # redirects land here too, since they aren't followed
+            err.read()
+            return err.code, err.headers.get('Server-Timing', '')
+
+
+##############################################################################
+# Running and reporting
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def run_route(clients, steps, requests, warmup):
+    """Send `requests` requests (after `warmup` unmeasured ones) for a route.
+
+    Each client works through its share of the requests in its own thread.
+    Returns the summary stored in the results file.
+    """
+
+    def work(client, count):
+        timings = []
+        for i in range(count):
+            method, path = steps[i % len(steps)]
+            started = time.perf_counter()
+            status, server_timing = client.request(method, path)
+            elapsed = time.perf_counter() - started
+
+            queries = SERVER_TIMING_QUERIES.search(server_timing)
+            timings.append((elapsed, status,
+                            int(queries.group(1)) if queries else None))
+        return timings
+
+    # whole cycles, so toggles leave the data as it was
+    warmup -= warmup % len(steps)
+    for client in clients:
+        work(client, warmup)
+
+    shares = [requests // len(clients)] * len(clients)
+    shares[0] += requests % len(clients)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(len(clients)) as pool:
+        results = pool.map(work, clients, shares)
+        timings = [timing for result in results for timing in result]
+    wall = time.perf_counter() - started
+
+    latencies = sorted(elapsed * 1000 for elapsed, _, _ in timings)
+    queries = [count for _, _, count in timings if count is not None]
+
+    return dict(
+        requests=len(timings),
+        errors=sum(1 for _, status, _ in timings if status >= 400),
+        throughput=round(len(timings) / wall, 2),
+        mean_ms=round(sum(latencies) / len(latencies), 3),
+        p50_ms=round(percentile(latencies, 50), 3),
+        p95_ms=round(percentile(latencies, 95), 3),
+        p99_ms=round(percentile(latencies, 99), 3),
+        queries_per_request=(round(sum(queries) / len(queries), 2)
+                             if queries else None),
+    )
+
+
+def git_commit():
+    """(commit hash, has uncommitted changes), or ('unknown', False)."""
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                cwd=repo, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain',
+                                 '--untracked-files=no'],
+                                cwd=repo, capture_output=True, text=True,
+                                check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+    return commit, bool(status.strip())
+
+
+def print_table(routes, baseline=None):
+    columns = ['req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'errors']
+    print(f"{'route':<14}" + "".join(f"{column:>12}" for column in columns))
+
+    for name, result in routes.items():
+        values = [result['throughput'], result['p50_ms'], result['p95_ms'],
+                  result['p99_ms'], result['queries_per_request'],
+                  result['errors']]
+        print(f"{name:<14}" + "".join(f"{str(value):>12}" for value in values))
+
+        old = (baseline or {}).get(name)
+        if old:
+            changes = []
+            for key in ['throughput', 'p50_ms', 'p95_ms', 'p99_ms']:
+                if old[key]:
+                    change = (result[key] - old[key]) / old[key] * 100
+                    changes.append(f"{change:+.1f}%")
+                else:
+                    changes.append("-")
+            queries = result['queries_per_request']
+            old_queries = old['queries_per_request']
+            changes.append(f"{queries - old_queries:+g}"
+                           if None not in (queries, old_queries) else "-")
+            print(f"{'  vs base':<14}" +
+                  "".join(f"{change:>12}" for change in changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database',
+                        help='database URL to seed and benchmark; it is '
+                             'dropped and recreated, so it is required '
+                             'unless --no-seed is given (then it defaults to '
+                             'DATABASE_URL_FIXED or the app default)')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=20,
+                        help='messages per user')
+    parser.add_argument('--follows', type=int, default=50,
+                        help='users each user follows')
+    parser.add_argument('--likes', type=int, default=20,
+                        help='messages each user likes')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed, so runs use the same dataset')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='reuse the data already in the database')
+    parser.add_argument('--seed-only', action='store_true',
+                        help='seed the database and stop')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='unmeasured requests per route and client first')
+    parser.add_argument('--url',
+                        help='benchmark a running server at this URL instead '
+                             'of the in-process test client')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='parallel clients (with --url)')
+    parser.add_argument('--routes', nargs='+',
+                        help='only benchmark these routes')
+    parser.add_argument('--out', default='bench_results',
+                        help='directory to write the JSON results to')
+    parser.add_argument('--compare',
+                        help='an earlier results file to compare against')
+    args = parser.parse_args()
+
+    if not args.no_seed and args.database in (None, APP_DATABASE):
+        parser.error("seeding drops every table: give a scratch --database "
+                     "(not the app's own), or pass --no-seed")
+
+    if args.database:
+        os.environ['DATABASE_URL_FIXED'] = args.database
+
+    # importing the app connects to the database, so only do it now
+    import app  # noqa: F401
+    from models import db
+
+    if not args.no_seed:
+        seed_dataset(args)
+    if args.seed_only:
+        return
+
+    targets = pick_targets()
+
+    if args.url:
+        clients = [HTTPClient(args.url) for i in range(args.concurrency)]
+    else:
+        if args.concurrency != 1:
+            parser.error("--concurrency needs --url")
+        clients = [TestClient(targets['viewer'])]
+
+    routes = {}
+    for name, steps in benchmark_routes(targets):
+        if args.routes and name not in args.routes:
+            continue
+        report(f"benchmarking {name}...")
+        routes[name] = run_route(clients, steps, args.requests, args.warmup)
+
+    commit, dirty = git_commit()
+    results = dict(
+        commit=commit,
+        dirty=dirty,
+        recorded_at=datetime.utcnow().isoformat(timespec='seconds'),
+        database=db.engine.dialect.name,
+        target=args.url or 'test-client',
+        concurrency=len(clients),
+        dataset=dict(users=args.users, messages=args.messages,
+                     follows=args.follows, likes=args.likes, seed=args.seed,
+                     reused=args.no_seed),
+        routes=routes,
+    )
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['routes']
+
+    print_table(routes, baseline)
+
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out,
+                        f"{commit}{'-dirty' if dirty else ''}-{results['database']}.json")
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    report(f"results written to {path}")
+
+
+if __name__ == '__main__':
+    main()
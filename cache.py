@@ -0,0 +1,151 @@
+"""Small caches.
+
+TTLCache and LRUCache live in-process: each gunicorn worker has its own
+copy, so anything cached in them can be stale in other workers. Only cache
+data where that's harmless: a few seconds of staleness with a short TTL, or
+keys that change whenever the data does. RedisCache is shared by all
+workers.
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class TTLCache:
+    """A dict-like cache whose entries expire `ttl` seconds after being set.
+
+    Holds at most `maxsize` entries; when full, expired entries are dropped
+    first and then the oldest ones.
+    """
+
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value for `key`, or `default` if missing/expired."""
+
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self.delete(key)
+            return default
+
+        return value
+
+    def set(self, key, value):
+        """Cache `value` under `key` for the next `ttl` seconds."""
+
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.maxsize:
+                self._evict()
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def delete(self, key):
+        """Forget `key`, if it is cached."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget everything."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        """Make room for one entry. Caller must hold the lock."""
+
+        now = time.monotonic()
+        expired = [key for key, (expires_at, _) in self._entries.items()
+                   if expires_at < now]
+        for key in expired:
+            del self._entries[key]
+
+        if len(self._entries) >= self.maxsize:
+            # dicts keep insertion order, so the first key is the oldest
+            del self._entries[next(iter(self._entries))]
+
+
+class LRUCache:
+    """A dict-like cache holding the `maxsize` most recently used entries.
+
+    Entries don't expire; use this for values whose key changes whenever
+    the value would (e.g. keys that include a row's updated_at).
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value for `key`, or `default` if missing."""
+
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self._entries[key]
+
+    def set(self, key, value):
+        """Cache `value` under `key`, dropping the least recently used entry
+        if the cache is full."""
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Forget `key`, if it is cached."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget everything."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache:
+    """A cache of strings shared by every worker, kept in Redis.
+
+    Needs the `redis` package, which is only imported when one of these is
+    made. Keys are namespaced with `prefix` and expire after `ttl` seconds,
+    leaving eviction beyond that to Redis's own maxmemory policy.
+    """
+
+    def __init__(self, url, ttl=24 * 60 * 60, prefix='warbler:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        value = self.client.get(self.prefix + key)
+        return default if value is None else value.decode('utf-8')
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            self.client.delete(key)
@@ -0,0 +1,90 @@
+"""The logged-in user, loaded cheaply on every request.
+
+Most requests only need a handful of columns from the session user's
+row (for the navbar, permission checks, etc.). Those columns are cached
+per process for a few seconds; the full User object is only loaded from
+the database when a view touches anything else.
+"""
+
+from cache import TTLCache
+from models import Block, User
+
+# Columns of the session user's row that are cached between requests.
+SESSION_USER_FIELDS = ('id', 'username', 'image_url', 'is_admin', 'is_private',
+                       'updated_at')
+
+# Seconds a cached session user is trusted before re-reading the row.
+SESSION_USER_TTL = 30
+
+_session_users = TTLCache(ttl=SESSION_USER_TTL)
+
+
+class CurrentUserGone(Exception):
+    """The session user's row was deleted after its columns were cached."""
+
+
+class CurrentUser:
+    """Stand-in for the logged-in User.
+
+    Cached columns are plain attributes. Any other attribute or method
+    (relationships, counters, follow(), ...) loads the real User row on
+    first use and is delegated to it.
+    """
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+        self._user = None
+
+    def load(self):
+        """Get the full User object for this user (one query, then cached)."""
+
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        return self._user
+
+    # block checks come from the blocks index, without loading the row
+
+    def is_blocking(self, other_user):
+        return other_user.id in Block.sets_for(self.id)[0]
+
+    def is_blocked(self, other_user):
+        return other_user.id in Block.sets_for(self.id)[1]
+
+    def __getattr__(self, name):
+        # only called for attributes that aren't cached columns
+        user = self.load()
+        if user is None:
+            raise CurrentUserGone(self.id)
+        return getattr(user, name)
+
+    def __eq__(self, other):
+        return (isinstance(other, (User, CurrentUser))
+                and other.id == self.id)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+
+def load_current_user(user_id):
+    """Get the CurrentUser for `user_id`, or None if there's no such user."""
+
+    fields = _session_users.get(user_id)
+
+    if fields is None:
+        columns = [getattr(User, field) for field in SESSION_USER_FIELDS]
+        row = User.query.with_entities(*columns).filter(User.id == user_id).first()
+        if row is None:
+            return None
+        fields = dict(zip(SESSION_USER_FIELDS, row))
+        _session_users.set(user_id, fields)
+
+    return CurrentUser(fields)
+
+
+def forget_current_user(user_id):
+    """Drop the cached row of `user_id` after it was edited or deleted."""
+
+    _session_users.delete(user_id)
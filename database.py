@@ -0,0 +1,108 @@
+"""Database engine and session setup.
+
+Read replica: when a 'replica' bind is configured (SQLALCHEMY_BINDS, see
+app.py), views decorated with @read_replica send their SELECTs to it.
+Writes and everything else still go to the primary. A replica lags a
+little behind, so for REPLICA_STICKY_SECONDS after a user changes
+something (any successful non-GET request) their reads stay on the
+primary, and they see their own change.
+
+Statement timeout: on PostgreSQL every transaction begun during a request
+runs `SET LOCAL statement_timeout`, so one slow query can't hold a worker
+for long. Scripts and the job worker are not limited.
+"""
+
+import time
+from functools import wraps
+
+from flask import (current_app, g, has_app_context, has_request_context,
+                   request, session)
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine
+
+REPLICA_BIND = 'replica'
+
+
+def in_request():
+    # the test client can leave a request context behind its app context
+    return has_request_context() and has_app_context()
+
+
+def has_replica(app):
+    return REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from the replica when the view asked for it."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if (not self._flushing
+                and getattr(clause, 'is_select', False)
+                and in_request()
+                and g.get('use_replica')
+                and has_replica(self.app)):
+            return get_state(self.app).db.get_engine(self.app,
+                                                     bind=REPLICA_BIND)
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy using RoutingSession.
+
+    DATABASE_POOL_OPTIONS are passed to each engine whose database pools
+    connections, so a SQLite bind next to a PostgreSQL primary (or the
+    other way round) gets only the options it takes.
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        if sa_url.get_backend_name() != 'sqlite':
+            options.update(app.config.get('DATABASE_POOL_OPTIONS') or {})
+        return super().apply_driver_hacks(app, sa_url, options)
+
+
+def read_replica(func):
+    """Let a read-only view read from the replica, if there is one.
+
+    Users who wrote something in the last REPLICA_STICKY_SECONDS keep
+    reading from the primary.
+    """
+
+    @wraps(func)
+    def wrap(*args, **kwargs):
+        if session.get('primary_until', 0) < time.time():
+            g.use_replica = True
+        return func(*args, **kwargs)
+    return wrap
+
+
+def init_database(app):
+    """Add replica stickiness and statement timeouts to `app`."""
+
+    app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+    app.config.setdefault('STATEMENT_TIMEOUT_MS', None)
+
+    @app.after_request
+    def stick_to_primary_after_write(response):
+        if (has_replica(app)
+                and request.method not in ('GET', 'HEAD', 'OPTIONS')
+                and response.status_code < 400):
+            session['primary_until'] = (time.time()
+                                        + app.config['REPLICA_STICKY_SECONDS'])
+        return response
+
+    if not event.contains(Engine, 'begin', set_statement_timeout):
+        event.listen(Engine, 'begin', set_statement_timeout)
+
+
+def set_statement_timeout(conn):
+    if conn.dialect.name != 'postgresql' or not in_request():
+        return
+
+    timeout = current_app.config['STATEMENT_TIMEOUT_MS']
+    if timeout:
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout)}")
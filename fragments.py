@@ -0,0 +1,82 @@
+"""Cached template fragments.
+
+Adds a `{% cache %}` tag to Jinja. The parts of a template that look the
+same to every viewer are rendered once and reused:
+
+    {% cache 'user', user.id, user.updated_at %}
+      ... markup that only depends on the user's row ...
+    {% endcache %}
+
+The values after `cache` make up the key, along with the template name
+and line, so a key must include everything the fragment shows that can
+change (usually an id and an updated_at). Entries are never invalidated;
+when a row changes its key changes too, and the stale entry ages out of
+the LRU. Anything that depends on the logged-in user (like hearts, follow
+buttons) has to stay outside the block.
+
+By default each worker keeps its own LRU of FRAGMENT_CACHE_SIZE entries.
+Setting FRAGMENT_CACHE_URL to a redis:// URL shares one cache between
+workers instead (this needs the `redis` package). FRAGMENT_CACHE_SIZE = 0
+turns caching off.
+"""
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from cache import LRUCache, RedisCache
+
+
+class FragmentCacheExtension(Extension):
+    """The `{% cache key, ... %}...{% endcache %}` tag."""
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        parts = [nodes.Const(f"{parser.name}:{lineno}"),
+                 parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+
+        return nodes.CallBlock(
+            self.call_method('_render', [nodes.List(parts)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _render(self, parts, caller):
+        cache = self.environment.fragment_cache
+        if cache is None:
+            return caller()
+
+        key = "fragment:" + ":".join(str(part) for part in parts)
+        html = cache.get(key)
+        if html is None:
+            html = caller()
+            cache.set(key, str(html))
+
+        return Markup(html)
+
+
+def init_fragment_cache(app):
+    """Enable the `{% cache %}` tag on `app` with the configured backend."""
+
+    app.config.setdefault('FRAGMENT_CACHE_SIZE', 10000)
+    app.config.setdefault('FRAGMENT_CACHE_URL', None)
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
+
+    if app.config['FRAGMENT_CACHE_URL']:
+        cache = RedisCache(app.config['FRAGMENT_CACHE_URL'])
+    elif app.config['FRAGMENT_CACHE_SIZE'] > 0:
+        cache = LRUCache(app.config['FRAGMENT_CACHE_SIZE'])
+    else:
+        cache = None
+
+    app.jinja_env.fragment_cache = cache
@@ -3,12 +3,21 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Rows are written as they are generated, so memory use stays flat even for
+load-testing sizes, and nothing is fetched over the network:
+
+    python generator/create_csvs.py
+    python generator/create_csvs.py --users 1000000 --messages 50000000 \\
+        --follows 100000000 --out /tmp/warbler-big
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import sys
+from random import choice, randint, sample, seed
+
 from faker import Faker
 from helpers import get_random_datetime
 
@@ -22,6 +31,12 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
+# Faker is slow, so big runs draw message text from a fixed pool of
+# paragraphs instead of generating a new one per message.
+TEXT_POOL_SIZE = 10000
+
+PROGRESS_EVERY = 1000000
+
 fake = Faker()
 
 # Generate random profile image URLs to use for users
@@ -32,46 +47,108 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs to use for users (picked by URL; nothing is downloaded)
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
+    f"https://picsum.photos/seed/warbler{i}/1200/400"
     for i in range(1, 46)
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(followee=followed_user, follower=follower))
+
+def report(name, count):
+    if count % PROGRESS_EVERY == 0:
+        print(f"{name}: {count:,} rows", file=sys.stderr, flush=True)
+
+
+def write_users(path, num_users):
+    with open(path, 'w') as users_csv:
+        users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
+        users_writer.writeheader()
+
+        for i in range(num_users):
+            # the row number keeps usernames and emails unique at any size
+            users_writer.writerow(dict(
+                email=f"{i}.{fake.email()}",
+                username=f"{fake.user_name()}{i}",
+                image_url=choice(image_urls),
+                password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
+                bio=fake.sentence(),
+                header_image_url=choice(header_image_urls),
+                location=fake.city()
+            ))
+            report('users', i + 1)
+
+
+def write_messages(path, num_messages, num_users):
+    texts = [fake.paragraph()[:MAX_WARBLER_LENGTH]
+             for i in range(min(num_messages, TEXT_POOL_SIZE))]
+
+    with open(path, 'w') as messages_csv:
+        messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
+        messages_writer.writeheader()
+
+        for i in range(num_messages):
+            messages_writer.writerow(dict(
+                text=choice(texts),
+                timestamp=get_random_datetime(),
+                user_id=randint(1, num_users)
+            ))
+            report('messages', i + 1)
+
+
+def write_follows(path, num_follows, num_users):
+    """Write `num_follows` distinct (followee, follower) pairs.
+
+    Follows are spread evenly over followers. Each follower's followees
+    are a random sample without replacement, so there are no duplicate
+    or self follows, and only one follower's sample is in memory at once.
+    """
+
+    max_follows = num_users * (num_users - 1)
+    if num_follows > max_follows:
+        raise ValueError(f"{num_users} users can make at most "
+                         f"{max_follows} follows")
+
+    per_follower, extra = divmod(num_follows, num_users)
+    written = 0
+
+    with open(path, 'w') as follows_csv:
+        follows_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
+        follows_writer.writeheader()
+
+        for follower in range(1, num_users + 1):
+            count = per_follower + (1 if follower <= extra else 0)
+            # sample one extra in case the follower picks themselves
+            followees = sample(range(1, num_users + 1), min(count + 1, num_users))
+            followees = [user for user in followees if user != follower][:count]
+
+            for followee in followees:
+                follows_writer.writerow(dict(followee=followee, follower=follower))
+                written += 1
+                report('follows', written)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Warbler CSVs.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--out', default='generator',
+                        help='directory to write the CSVs to')
+    parser.add_argument('--seed', type=int,
+                        help='random seed, for repeatable datasets')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        seed(args.seed)
+        Faker.seed(args.seed)
+
+    os.makedirs(args.out, exist_ok=True)
+
+    write_users(f"{args.out}/users.csv", args.users)
+    write_messages(f"{args.out}/messages.csv", args.messages, args.users)
+    write_follows(f"{args.out}/follows.csv", args.follows, args.users)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""In-memory index of the follow graph.
+
+Questions like "who to follow" need the follows of the people you follow,
+which through the ORM means loading whole user lists per request. This
+keeps the follows table in memory in compressed sparse row (CSR) form: for
+each direction, one flat array of user ids sorted by source, plus an
+offsets array so a user's neighbours are the slice
+targets[offsets[id]:offsets[id + 1]].
+
+The arrays are built from the database in two streamed, index-ordered
+queries. After that, follows and unfollows are applied as small per-user
+deltas once their transaction commits (see record()), so the index stays
+current without rebuilding. It is rebuilt from the database when the
+deltas grow past COMPACT_AFTER edges or it is older than GRAPH_MAX_AGE
+seconds. The rebuild runs in a background thread, on its own connection,
+and queries keep using the old arrays until the new ones are swapped in;
+only the very first build, when there is nothing to serve yet, makes a
+request wait.
+
+Like the caches in cache.py, each worker process has its own index.
+Changes made in other processes show up when it is next rebuilt.
+"""
+
+import time
+from array import array
+from collections import Counter, defaultdict
+from threading import Lock, RLock, Thread
+
+from sqlalchemy import event, func, select
+
+# Delta edges kept before the arrays are rebuilt from the database.
+COMPACT_AFTER = 10000
+
+# How many followees of followees are looked at for suggestions.
+SUGGESTION_FANOUT = 500
+
+
+class AdjacencyArrays:
+    """One direction of the graph in CSR form.
+
+    Built from (source, target) pairs sorted by source; `size` must be
+    larger than every source id.
+    """
+
+    def __init__(self, pairs, size):
+        # ids are int4; offsets index into targets, which can pass 2**31
+        self.offsets = array('q', [0]) * (size + 1)
+        self.targets = array('i')
+
+        last_source = 0
+        for source, target in pairs:
+            while last_source < source:
+                last_source += 1
+                self.offsets[last_source] = len(self.targets)
+            self.targets.append(target)
+
+        for source in range(last_source + 1, size + 1):
+            self.offsets[source] = len(self.targets)
+
+    def neighbors(self, source):
+        if not 0 <= source < len(self.offsets) - 1:
+            return ()
+        return self.targets[self.offsets[source]:self.offsets[source + 1]]
+
+
+class FollowGraph:
+    """Who follows whom, for fast set operations on follow lists."""
+
+    def __init__(self, db, model):
+        self.db = db
+        self.model = model
+        self.max_age = 300
+        self.logger = None
+        self._lock = RLock()
+        self._building = Lock()
+        self._following = None
+        self._followers = None
+        self._built_at = 0
+        self._refresher = None
+        # changes committed during a build, replayed on its result
+        self._journal = None
+        self._reset_deltas()
+
+    def init_app(self, app):
+        app.config.setdefault('GRAPH_MAX_AGE', 300)
+        self.max_age = app.config['GRAPH_MAX_AGE']
+        self.logger = app.logger
+
+        # apply a session's follow changes only once they're committed
+        session = self.db.session
+        if not event.contains(session, 'after_commit',
+                              self._apply_session_changes):
+            event.listen(session, 'after_commit', self._apply_session_changes)
+            event.listen(session, 'after_rollback', self._drop_session_changes)
+
+    # building and keeping up to date
+
+    def _reset_deltas(self):
+        # direction -> user id -> set of user ids
+        self._added = {'following': defaultdict(set),
+                       'followers': defaultdict(set)}
+        self._removed = {'following': defaultdict(set),
+                         'followers': defaultdict(set)}
+        self._delta_size = 0
+
+    def build(self):
+        """Load the whole graph from the follows table and swap it in."""
+
+        with self._building:
+            self._build()
+
+    def _build(self):
+        # Reads on a connection of its own, without holding _lock, so
+        # queries carry on meanwhile. Caller must hold _building.
+        Follow = self.model
+
+        with self._lock:
+            self._journal = []
+        try:
+            with self.db.engine.connect() as connection:
+                connection = connection.execution_options(stream_results=True)
+
+                max_follower, max_followee = connection.execute(
+                    select(func.max(Follow.follower),
+                           func.max(Follow.followee))).one()
+                size = max(max_follower or 0, max_followee or 0) + 1
+
+                following = AdjacencyArrays(
+                    connection.execute(
+                        select(Follow.follower, Follow.followee)
+                        .order_by(Follow.follower, Follow.followee)),
+                    size)
+                followers = AdjacencyArrays(
+                    connection.execute(
+                        select(Follow.followee, Follow.follower)
+                        .order_by(Follow.followee, Follow.follower)),
+                    size)
+        except Exception:
+            with self._lock:
+                self._journal = None
+            raise
+
+        with self._lock:
+            journal, self._journal = self._journal, None
+            self._following, self._followers = following, followers
+            self._reset_deltas()
+            for change in journal:
+                self._apply(*change)
+            self._built_at = time.monotonic()
+
+    def invalidate(self):
+        """Rebuild from the database on next use."""
+
+        with self._lock:
+            self._following = None
+
+    def _ensure_built(self):
+        if self._following is None:
+            # nothing to serve yet, so this one has to wait
+            with self._building:
+                if self._following is None:
+                    self._build()
+        elif (self._delta_size > COMPACT_AFTER
+                or time.monotonic() - self._built_at > self.max_age):
+            self._refresh_in_background()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = Thread(target=self._refresh,
+                                     name='follow-graph-refresh', daemon=True)
+        self._refresher.start()
+
+    def _refresh(self):
+        try:
+            self.build()
+        except Exception:
+            if self.logger:
+                self.logger.exception("Rebuilding the follow graph failed")
+            # try again after another GRAPH_MAX_AGE, not on every read
+            self._built_at = time.monotonic()
+        finally:
+            self._refresher = None
+
+    def record(self, session, change, follower, followee):
+        """Note that `follower` started ('add') or stopped ('remove')
+        following `followee` in `session`'s transaction.
+
+        Applied to the index when the transaction commits.
+        """
+
+        session.info.setdefault('follow_graph_changes', []).append(
+            (change, follower, followee))
+
+    def _apply_session_changes(self, session):
+        changes = session.info.pop('follow_graph_changes', ())
+        with self._lock:
+            for change, follower, followee in changes:
+                self._apply(change, follower, followee)
+
+    def _drop_session_changes(self, session):
+        session.info.pop('follow_graph_changes', None)
+
+    def _apply(self, change, follower, followee):
+        if self._journal is not None:
+            self._journal.append((change, follower, followee))
+        if self._following is None:
+            return
+
+        for direction, source, target in [('following', follower, followee),
+                                          ('followers', followee, follower)]:
+            if change == 'add':
+                self._removed[direction][source].discard(target)
+                self._added[direction][source].add(target)
+            else:
+                self._added[direction][source].discard(target)
+                self._removed[direction][source].add(target)
+        self._delta_size += 1
+
+    # queries
+
+    def _neighbors(self, direction, user_id):
+        self._ensure_built()
+        with self._lock:
+            arrays = (self._following if direction == 'following'
+                      else self._followers)
+            result = set(arrays.neighbors(user_id))
+            result -= self._removed[direction].get(user_id, set())
+            result |= self._added[direction].get(user_id, set())
+        return result
+
+    def following(self, user_id):
+        """Ids of the users `user_id` follows."""
+
+        return self._neighbors('following', user_id)
+
+    def followers(self, user_id):
+        """Ids of the users following `user_id`."""
+
+        return self._neighbors('followers', user_id)
+
+    def mutuals(self, user_id):
+        """Ids of users who follow `user_id` and are followed back."""
+
+        return self.following(user_id) & self.followers(user_id)
+
+    def mutual_followers(self, user_id, other_id):
+        """Ids of users who follow both `user_id` and `other_id`."""
+
+        return self.followers(user_id) & self.followers(other_id)
+
+    def followed_by_following(self, viewer_id, user_id):
+        """Ids of users `viewer_id` follows who follow `user_id`."""
+
+        return self.following(viewer_id) & self.followers(user_id)
+
+    def suggestions(self, user_id, limit=5, exclude=()):
+        """Users to suggest `user_id` follows, best first.
+
+        Ranks users by how many of the people `user_id` follows follow
+        them. Returns [(suggested id, [ids of those people]), ...],
+        leaving out `user_id`, users they already follow and `exclude`.
+        """
+
+        following = self.following(user_id)
+        skip = following | set(exclude) | {user_id}
+
+        counts = Counter()
+        via = defaultdict(list)
+        for followee in sorted(following)[:SUGGESTION_FANOUT]:
+            for candidate in self.following(followee):
+                if candidate not in skip:
+                    counts[candidate] += 1
+                    via[candidate].append(followee)
+
+        return [(candidate, via[candidate])
+                for candidate, count in counts.most_common(limit)]
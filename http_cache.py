@@ -0,0 +1,115 @@
+"""HTTP caching: conditional GETs for pages, long-lived static assets.
+
+Pages that rarely change (profiles, single messages) get a weak ETag made
+from the few values they are rendered from: row versions (updated_at),
+counters, and whatever the logged-in viewer sees differently (follow
+buttons, hearts, the navbar). A browser that sends the ETag back in
+If-None-Match gets a bodyless 304 before anything is rendered. These pages
+are sent `private, no-cache`, so browsers revalidate them every time and
+shared caches don't keep them.
+
+Static files are linked with static_url(), which adds a fingerprint of the
+file's contents to the URL. Fingerprinted URLs change whenever the file
+does, so they're served as immutable for a year.
+
+Responses without a policy of their own keep the app-wide no-store.
+"""
+
+import hashlib
+import os
+import time
+
+from flask import current_app, g, make_response, request, session, url_for
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+# file name -> (mtime, fingerprint)
+_fingerprints = {}
+
+
+def make_etag(*parts):
+    """A short hash of `parts`, which must have stable reprs."""
+
+    return hashlib.blake2b(repr(parts).encode('utf-8'),
+                           digest_size=12).hexdigest()
+
+
+def viewer_version():
+    """What every page shows differently per logged-in user.
+
+    That's who they are, their navbar (username and picture, which change
+    with updated_at), and the age of the CSRF token in the post modal:
+    it is signed with a timestamp, so pages are only reused within a window
+    short enough for the token to stay valid.
+    """
+
+    if not g.user:
+        return None
+
+    time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600) or 3600
+    token_window = int(time.time() // (time_limit / 2))
+
+    return (g.user.id, g.user.updated_at, g.user.is_admin, token_window)
+
+
+def conditional(render, *parts):
+    """Respond with 304 if the client has this page, else with `render()`.
+
+    `parts` are everything the page depends on besides the URL and the
+    viewer; they're hashed into a weak ETag together with viewer_version().
+    """
+
+    # flashed messages are only shown once, so don't answer with a 304
+    # that would leave them waiting for the next page
+    if session.get('_flashes'):
+        return render()
+
+    etag = make_etag(request.full_path, viewer_version(), *parts)
+
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def fingerprint(filename, static_folder):
+    """Hash of a static file's contents, recomputed when it's modified."""
+
+    path = os.path.join(static_folder, filename)
+    mtime = os.path.getmtime(path)
+
+    cached = _fingerprints.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, 'rb') as static_file:
+        digest = hashlib.blake2b(static_file.read(), digest_size=6).hexdigest()
+    _fingerprints[filename] = (mtime, digest)
+    return digest
+
+
+def init_http_cache(app):
+    """Add static_url() to templates and cache headers for static files."""
+
+    @app.template_global()
+    def static_url(filename):
+        """URL of a static file, fingerprinted so it can be cached forever."""
+
+        try:
+            version = fingerprint(filename, app.static_folder)
+        except OSError:
+            return url_for('static', filename=filename)
+        return url_for('static', filename=filename, v=version)
+
+    @app.after_request
+    def cache_static_files(response):
+        if request.endpoint == 'static' and request.args.get('v'):
+            response.headers['Cache-Control'] = (
+                f"public, max-age={STATIC_MAX_AGE}, immutable")
+            response.expires = None
+        return response
@@ -0,0 +1,150 @@
+"""A job queue kept in the database.
+
+Some side effects are too slow to run inside a request. Examples are
+delivering a message to every follower's timeline, clearing a timeline
+after an unfollow, and deleting an account with everything it owns. These
+are queued as rows in the jobs table, in the same transaction as the
+change that caused them, so a job exists only if that change was
+committed. worker.py runs them later.
+
+Handlers are plain functions registered under a name:
+
+    @jobs.handler('purge_timeline')
+    def purge_timeline(user_id, author_id):
+        ...
+
+    jobs.enqueue('purge_timeline', key=f"purge_timeline:{u}:{a}",
+                 user_id=u, author_id=a)
+
+A job runs in its own transaction and is deleted in that same transaction,
+so its effects and its removal are committed together. If a handler
+raises, the job is retried later with exponential backoff, up to
+JOBS_MAX_ATTEMPTS times. After that it's kept with status 'failed' for a
+look. Jobs can run more than once (e.g. a worker dies just before
+committing), so handlers must be idempotent.
+
+`key` is an idempotency key: while a job with the same key is waiting,
+enqueueing it again does nothing.
+
+With JOBS_INLINE set, jobs run right away inside the current request
+instead. Tests use this, and so can development without a worker.
+"""
+
+import time
+from datetime import datetime, timedelta
+
+
+class JobQueue:
+    """Queues jobs as rows of `model` and runs them with their handlers."""
+
+    def __init__(self, db, model):
+        self.db = db
+        self.model = model
+        self.handlers = {}
+        self.app = None
+
+    def init_app(self, app):
+        app.config.setdefault('JOBS_INLINE', False)
+        app.config.setdefault('JOBS_MAX_ATTEMPTS', 5)
+        app.config.setdefault('JOBS_RETRY_DELAY', 10)
+        self.app = app
+
+    def handler(self, kind):
+        """Register the decorated function as the handler for `kind` jobs."""
+
+        def register(func):
+            self.handlers[kind] = func
+            return func
+        return register
+
+    def enqueue(self, kind, key=None, **payload):
+        """Queue a `kind` job called with `payload`, which must be JSON-able.
+
+        Added to the current transaction; the caller commits it.
+        """
+
+        if kind not in self.handlers:
+            raise ValueError(f"No handler for {kind} jobs")
+
+        if self.app.config['JOBS_INLINE']:
+            self.handlers[kind](**payload)
+            return
+
+        if key is not None:
+            waiting = (self.model.query
+                       .filter(self.model.key == key,
+                               self.model.status == 'pending')
+                       .first())
+            if waiting:
+                return
+
+        self.db.session.add(self.model(kind=kind, key=key, payload=payload))
+
+    def run_next(self):
+        """Run the next due job, if there is one. Returns whether one ran.
+
+        The job's row stays locked while it runs (on PostgreSQL; other
+        workers skip it), so each job is handled by one worker at a time.
+        """
+
+        Job = self.model
+        job = (Job.query
+               .filter(Job.status == 'pending',
+                       Job.run_at <= datetime.utcnow())
+               .order_by(Job.run_at, Job.id)
+               .with_for_update(skip_locked=True)
+               .first())
+
+        if job is None:
+            self.db.session.rollback()
+            return False
+
+        job_id, kind, payload = job.id, job.kind, job.payload
+        started = time.monotonic()
+
+        try:
+            self.handlers[kind](**payload)
+            self.db.session.delete(job)
+            self.db.session.commit()
+        except Exception as exc:
+            self.db.session.rollback()
+            self._failed(job_id, exc)
+        else:
+            self.app.logger.info("Ran %s job %d in %.3fs",
+                                 kind, job_id, time.monotonic() - started)
+
+        return True
+
+    def run_pending(self, limit=100):
+        """Run up to `limit` due jobs. Returns how many ran."""
+
+        ran = 0
+        while ran < limit and self.run_next():
+            ran += 1
+        return ran
+
+    def _failed(self, job_id, exc):
+        """Schedule a retry of the job that raised `exc`, or give up on it."""
+
+        job = (self.model.query
+               .filter(self.model.id == job_id)
+               .with_for_update()
+               .first())
+        if job is None:
+            return
+
+        job.attempts += 1
+        job.last_error = f"{type(exc).__name__}: {exc}"
+
+        if job.attempts >= self.app.config['JOBS_MAX_ATTEMPTS']:
+            job.status = 'failed'
+            self.app.logger.error("Giving up on %s job %d after %d attempts",
+                                  job.kind, job.id, job.attempts,
+                                  exc_info=exc)
+        else:
+            delay = self.app.config['JOBS_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+            job.run_at = datetime.utcnow() + timedelta(seconds=delay)
+            self.app.logger.warning("%s job %d failed, retrying in %ds",
+                                    job.kind, job.id, delay, exc_info=exc)
+
+        self.db.session.commit()
@@ -0,0 +1,228 @@
+"""Per-request performance instrumentation.
+
+For every request this records how many SQL statements ran and how long
+they took, time spent rendering templates, and how many ORM objects were
+loaded. The numbers are:
+
+- sent back on the response as a Server-Timing header (visible in the
+  browser's network panel),
+- added to per-route totals served in Prometheus text format at /metrics
+  (only if METRICS_ENABLED, and then only to requests from this host or
+  bearing METRICS_TOKEN),
+- checked for N+1 patterns: if one statement shape runs more than
+  N_PLUS_ONE_THRESHOLD times in a request, a warning is logged.
+
+The counters are per process, like the caches in cache.py.
+"""
+
+import hmac
+import re
+import time
+from collections import Counter, defaultdict
+from threading import Lock
+
+from flask import (abort, g, has_app_context, has_request_context, request,
+                   Response, before_render_template, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db
+
+# Runs of bind parameters, e.g. the "(?, ?, ?)" of an expanded IN list, so
+# statements that only differ in list length count as the same shape.
+PARAMETER_LIST = re.compile(r"\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,?)+\)")
+
+# Addresses allowed to read /metrics without METRICS_TOKEN.
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+
+# Totals kept per route, in the order they appear on /metrics.
+ROUTE_TOTALS = [
+    ('requests', 'warbler_requests_total',
+     'Requests handled.'),
+    ('request_seconds', 'warbler_request_seconds_total',
+     'Time spent handling requests.'),
+    ('queries', 'warbler_sql_queries_total',
+     'SQL statements executed.'),
+    ('sql_seconds', 'warbler_sql_seconds_total',
+     'Time spent executing SQL.'),
+    ('template_seconds', 'warbler_template_seconds_total',
+     'Time spent rendering templates.'),
+    ('objects_loaded', 'warbler_orm_objects_loaded_total',
+     'ORM objects loaded from the database.'),
+    ('n_plus_one', 'warbler_n_plus_one_total',
+     'Requests flagged for repeating one statement too often.'),
+]
+
+
+class RequestMetrics:
+    """What one request did; kept on g.metrics while it runs."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.objects_loaded = 0
+        self.statement_shapes = Counter()
+        self._template_starts = []
+
+
+def current_metrics():
+    """The RequestMetrics of the running request, if there is one."""
+
+    # the test client can leave a request context behind its app context
+    if has_request_context() and has_app_context():
+        return g.get('metrics')
+    return None
+
+
+class Metrics:
+    """Flask extension wiring the instrumentation into an app."""
+
+    def __init__(self, app=None):
+        self._totals = defaultdict(Counter)
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('N_PLUS_ONE_THRESHOLD', 10)
+        app.config.setdefault('METRICS_ENABLED', False)
+        app.config.setdefault('METRICS_TOKEN', None)
+
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        event.listen(db.Model, 'load', self._object_loaded, propagate=True)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+        self.app = app
+
+    # SQL, ORM and template hooks
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        context.metrics_started = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        metrics = current_metrics()
+        if metrics is None:
+            return
+
+        metrics.queries += 1
+        metrics.sql_seconds += time.perf_counter() - context.metrics_started
+        metrics.statement_shapes[PARAMETER_LIST.sub("(?)", statement)] += 1
+
+    def _object_loaded(self, target, context):
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.objects_loaded += 1
+
+    def _before_render(self, sender, template, context, **extra):
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics._template_starts.append(time.perf_counter())
+
+    def _after_render(self, sender, template, context, **extra):
+        metrics = current_metrics()
+        if metrics is not None and metrics._template_starts:
+            started = metrics._template_starts.pop()
+            # count only the outermost render so nested ones aren't doubled
+            if not metrics._template_starts:
+                metrics.template_seconds += time.perf_counter() - started
+
+    # request lifecycle
+
+    def _start_request(self):
+        g.metrics = RequestMetrics()
+
+    def _finish_request(self, response):
+        metrics = g.pop('metrics', None)
+        if metrics is None:
+            return response
+
+        elapsed = time.perf_counter() - metrics.started
+        route = request.endpoint or 'unmatched'
+        repeated = self._repeated_statements(metrics)
+
+        for statement, count in repeated:
+            self.app.logger.warning(
+                "Possible N+1 in %s: statement ran %d times: %s",
+                route, count, statement)
+
+        with self._lock:
+            totals = self._totals[route]
+            totals['requests'] += 1
+            totals['request_seconds'] += elapsed
+            totals['queries'] += metrics.queries
+            totals['sql_seconds'] += metrics.sql_seconds
+            totals['template_seconds'] += metrics.template_seconds
+            totals['objects_loaded'] += metrics.objects_loaded
+            totals['n_plus_one'] += 1 if repeated else 0
+
+        response.headers['Server-Timing'] = ", ".join([
+            f'db;dur={metrics.sql_seconds * 1000:.2f};'
+            f'desc="{metrics.queries} queries"',
+            f'tpl;dur={metrics.template_seconds * 1000:.2f}',
+            f'orm;desc="{metrics.objects_loaded} objects"',
+            f'total;dur={elapsed * 1000:.2f}',
+        ])
+
+        return response
+
+    def _repeated_statements(self, metrics):
+        """(statement, count) for shapes run more than the threshold."""
+
+        threshold = self.app.config['N_PLUS_ONE_THRESHOLD']
+        return [(statement, count)
+                for statement, count in metrics.statement_shapes.items()
+                if count > threshold]
+
+    # exposition
+
+    def render(self):
+        """All per-route totals in Prometheus text format."""
+
+        with self._lock:
+            totals = {route: Counter(counts)
+                      for route, counts in self._totals.items()}
+
+        lines = []
+        for key, name, help_text in ROUTE_TOTALS:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for route in sorted(totals):
+                value = round(totals[route][key], 6)
+                lines.append(f'{name}{{route="{route}"}} {value}')
+
+        return "\n".join(lines) + "\n"
+
+    def _allowed(self):
+        """May this request read /metrics?
+
+        With METRICS_TOKEN set, only if it sends it as a bearer token;
+        otherwise only from this host (e.g. a scraper on the same box).
+        """
+
+        token = self.app.config['METRICS_TOKEN']
+        if token:
+            sent = request.headers.get('Authorization', '')
+            return hmac.compare_digest(sent.encode(),
+                                       f"Bearer {token}".encode())
+        return request.remote_addr in LOOPBACK_ADDRESSES
+
+    def metrics_view(self):
+        if not self.app.config['METRICS_ENABLED']:
+            abort(404)
+        if not self._allowed():
+            abort(403)
+        return Response(self.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+
+metrics = Metrics()
@@ -0,0 +1,104 @@
+"""Apply pending schema migrations.
+
+Migrations live in migrations/ as numbered Python files (0001_name.py,
+0002_name.py, ...), each with an upgrade(connection) function. Applied
+versions are recorded in the schema_migrations table, so running this
+again only applies new ones:
+
+    python migrate.py           # apply everything pending
+    python migrate.py --list    # show what is applied / pending
+
+A migration that sets TRANSACTIONAL = False runs on an autocommit
+connection instead of a transaction, which PostgreSQL needs for
+CREATE INDEX CONCURRENTLY.
+
+A database made from scratch with db.create_all() already has the latest
+schema; every migration is written to be a no-op on one. The exception
+is 0008, which partitions messages on PostgreSQL: create_all() can only
+make a plain table, so run the migrations after it there.
+"""
+
+import argparse
+import importlib.util
+import os
+import re
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, Column, Text, DateTime
+
+from app import db
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Text, primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def find_migrations():
+    """List (version, module) for every migration file, in order."""
+
+    migrations = []
+
+    for file_name in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = re.match(r'^(\d{4})_\w+\.py$', file_name)
+        if not match:
+            continue
+
+        spec = importlib.util.spec_from_file_location(
+            f"migrations.{file_name[:-3]}",
+            os.path.join(MIGRATIONS_DIR, file_name))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        migrations.append((file_name[:-3], module))
+
+    return migrations
+
+
+def applied_versions():
+    schema_migrations.create(db.engine, checkfirst=True)
+    with db.engine.connect() as connection:
+        return {row.version for row in
+                connection.execute(schema_migrations.select())}
+
+
+def apply(version, module):
+    """Run one migration and record it, in one transaction if possible."""
+
+    if getattr(module, 'TRANSACTIONAL', True):
+        module.upgrade(db.session.connection())
+    else:
+        with db.engine.connect() as connection:
+            module.upgrade(
+                connection.execution_options(isolation_level='AUTOCOMMIT'))
+
+    db.session.execute(schema_migrations.insert().values(
+        version=version, applied_at=datetime.utcnow()))
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply schema migrations.")
+    parser.add_argument('--list', action='store_true',
+                        help='only list migrations and their status')
+    args = parser.parse_args()
+
+    applied = applied_versions()
+
+    for version, module in find_migrations():
+        if version in applied:
+            status = 'applied'
+        elif args.list:
+            status = 'pending'
+        else:
+            print(f"applying {version}...", flush=True)
+            apply(version, module)
+            status = 'applied now'
+
+        print(f"{version}: {status} - {module.__doc__.splitlines()[0]}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+"""Add the timelines table for fan-out-on-write home feeds, and fill it."""
+
+from models import TimelineEntry
+
+
+def upgrade(connection):
+    if not connection.dialect.has_table(connection, 'timelines'):
+        TimelineEntry.__table__.create(connection)
+        TimelineEntry.rebuild()
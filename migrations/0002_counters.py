@@ -0,0 +1,29 @@
+"""Add denormalized message/follow/like counters and compute them."""
+
+from sqlalchemy import inspect, text
+
+from models import recount_counters
+
+COUNTER_COLUMNS = [
+    ('users', 'message_count'),
+    ('users', 'following_count'),
+    ('users', 'follower_count'),
+    ('users', 'liked_count'),
+    ('messages', 'like_count'),
+]
+
+
+def upgrade(connection):
+    inspector = inspect(connection)
+    added = False
+
+    for table, column in COUNTER_COLUMNS:
+        existing = {c['name'] for c in inspector.get_columns(table)}
+        if column not in existing:
+            connection.execute(text(
+                f"ALTER TABLE {table} "
+                f"ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0"))
+            added = True
+
+    if added:
+        recount_counters()
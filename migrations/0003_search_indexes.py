@@ -0,0 +1,17 @@
+"""Add trigram, prefix and full-text indexes for user search (PostgreSQL)."""
+
+from sqlalchemy import text
+
+from models import USER_SEARCH_INDEXES
+
+TRANSACTIONAL = False
+
+
+def upgrade(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+
+    connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    for statement in USER_SEARCH_INDEXES:
+        connection.execute(text(
+            statement.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY")))
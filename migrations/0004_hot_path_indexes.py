@@ -0,0 +1,33 @@
+"""Index messages by (user_id, timestamp) and association tables both ways.
+
+The association tables' primary keys only serve lookups on their first
+column; these add the reverse direction:
+
+- follows (follower, followee): who does X follow
+- blocks (blocker, blockee): who does X block
+- requests (recipient, sender): X's pending follow requests
+- likes (message_id, user_id): who liked message Y
+"""
+
+from sqlalchemy import text
+
+TRANSACTIONAL = False
+
+INDEXES = [
+    ('ix_messages_user_id_timestamp',
+     'messages (user_id, timestamp DESC, id DESC)'),
+    ('ix_follows_follower_followee', 'follows (follower, followee)'),
+    ('ix_blocks_blocker_blockee', 'blocks (blocker, blockee)'),
+    ('ix_requests_recipient_sender', 'requests (recipient, sender)'),
+    ('ix_likes_message_id_user_id', 'likes (message_id, user_id)'),
+]
+
+
+def upgrade(connection):
+    # building concurrently keeps the tables writable on PostgreSQL
+    create = ("CREATE INDEX CONCURRENTLY"
+              if connection.dialect.name == 'postgresql'
+              else "CREATE INDEX")
+
+    for name, columns in INDEXES:
+        connection.execute(text(f"{create} IF NOT EXISTS {name} ON {columns}"))
@@ -0,0 +1,18 @@
+"""Add users.updated_at, which keys the cached user card fragments."""
+
+from sqlalchemy import inspect, text
+
+
+def upgrade(connection):
+    existing = {c['name'] for c in inspect(connection).get_columns('users')}
+    if 'updated_at' in existing:
+        return
+
+    # SQLite can't add a column with a CURRENT_TIMESTAMP default, so add it
+    # empty and fill it in
+    connection.execute(text("ALTER TABLE users ADD COLUMN updated_at TIMESTAMP"))
+    connection.execute(text("UPDATE users SET updated_at = CURRENT_TIMESTAMP"))
+
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(
+            "ALTER TABLE users ALTER COLUMN updated_at SET NOT NULL"))
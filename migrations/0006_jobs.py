@@ -0,0 +1,8 @@
+"""Add the jobs table for work queued for worker.py."""
+
+from models import Job
+
+
+def upgrade(connection):
+    if not connection.dialect.has_table(connection, 'jobs'):
+        Job.__table__.create(connection)
@@ -0,0 +1,11 @@
+"""Add users.deleted_at, set on accounts waiting to be purged."""
+
+from sqlalchemy import inspect, text
+
+
+def upgrade(connection):
+    existing = {c['name'] for c in inspect(connection).get_columns('users')}
+    if 'deleted_at' in existing:
+        return
+
+    connection.execute(text("ALTER TABLE users ADD COLUMN deleted_at TIMESTAMP"))
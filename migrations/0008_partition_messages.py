@@ -0,0 +1,82 @@
+"""Range-partition messages by month (PostgreSQL).
+
+Rebuilds messages as a partitioned table with one partition per month
+(see partitions.py) and copies the rows over, in one transaction. The
+table is locked while it's copied, so run this in a maintenance window
+on a big database.
+
+A partitioned table's primary key has to include the partition column,
+so it becomes (id, timestamp). ids still come from the same sequence,
+so they stay unique. Foreign keys can only reference a unique key, and
+likes and timelines only have message_id, so their foreign keys to
+messages are dropped. Deleting a message or an account removes those
+rows explicitly instead (Message.destroy, the purge_user job).
+
+db.create_all() makes a plain messages table, so on PostgreSQL this
+also converts a freshly created database. Elsewhere it does nothing.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import text
+
+from partitions import add_months, create_partitions, month_start
+
+# months of empty partitions created past the current one
+MONTHS_AHEAD = 3
+
+
+def upgrade(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+
+    partitioned = connection.execute(text("""
+        SELECT 1 FROM pg_partitioned_table
+        WHERE partrelid = 'messages'::regclass
+    """)).scalar()
+    if partitioned:
+        return
+
+    for table in ('likes', 'timelines'):
+        connection.execute(text(
+            f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS "
+            f"{table}_message_id_fkey"))
+
+    connection.execute(text("ALTER TABLE messages RENAME TO messages_old"))
+    connection.execute(text(
+        "ALTER INDEX IF EXISTS ix_messages_user_id_timestamp "
+        "RENAME TO ix_messages_old_user_id_timestamp"))
+    # keep the id sequence when the old table is dropped
+    connection.execute(text("ALTER SEQUENCE messages_id_seq OWNED BY NONE"))
+
+    connection.execute(text("""
+        CREATE TABLE messages (
+            id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+            text VARCHAR(140) NOT NULL,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            user_id INTEGER NOT NULL
+                REFERENCES users (id) ON DELETE CASCADE,
+            like_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """))
+    connection.execute(text(
+        "ALTER SEQUENCE messages_id_seq OWNED BY messages.id"))
+    connection.execute(text(
+        "CREATE TABLE messages_default PARTITION OF messages DEFAULT"))
+
+    oldest = connection.execute(text(
+        "SELECT min(timestamp) FROM messages_old")).scalar()
+    this_month = month_start(datetime.utcnow())
+    create_partitions(connection, min(oldest or this_month, this_month),
+                      add_months(this_month, MONTHS_AHEAD))
+
+    connection.execute(text("""
+        INSERT INTO messages (id, text, timestamp, user_id, like_count)
+        SELECT id, text, timestamp, user_id, like_count FROM messages_old
+    """))
+    connection.execute(text("DROP TABLE messages_old"))
+
+    connection.execute(text(
+        "CREATE INDEX ix_messages_user_id_timestamp "
+        "ON messages (user_id, timestamp DESC, id DESC)"))
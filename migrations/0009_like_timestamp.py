@@ -0,0 +1,18 @@
+"""Add likes.timestamp, which trending scores are decayed by."""
+
+from sqlalchemy import inspect, text
+
+
+def upgrade(connection):
+    existing = {c['name'] for c in inspect(connection).get_columns('likes')}
+    if 'timestamp' not in existing:
+        # likes made before this have no time; count them as made now
+        connection.execute(text("ALTER TABLE likes ADD COLUMN timestamp TIMESTAMP"))
+        connection.execute(text("UPDATE likes SET timestamp = CURRENT_TIMESTAMP"))
+
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text(
+                "ALTER TABLE likes ALTER COLUMN timestamp SET NOT NULL"))
+
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_likes_timestamp ON likes (timestamp)"))
@@ -0,0 +1,15 @@
+"""Give users.updated_at a server default, for rows loaded in bulk.
+
+seed.py COPYs users straight from CSV, without the ORM's default, and
+the column is NOT NULL. Tables made by db.create_all() already have the
+default. SQLite can't add one to an existing column, so elsewhere this
+does nothing.
+"""
+
+from sqlalchemy import text
+
+
+def upgrade(connection):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(
+            "ALTER TABLE users ALTER COLUMN updated_at SET DEFAULT now()"))
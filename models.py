@@ -3,10 +3,42 @@
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, orm, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+from cache import TTLCache
+from database import RoutingSQLAlchemy, init_database
+from graph import FollowGraph
+from jobs import JobQueue
+from passwords import PasswordHasher
+from trending import Trending
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+password_hasher = PasswordHasher(bcrypt)
+
+# How many of an author's recent messages are copied into a timeline
+# when someone starts following them.
+TIMELINE_BACKFILL = 100
+
+# Rows of each table the purge_user job deletes per run.
+PURGE_BATCH = 1000
+
+# Users whose timelines TimelineEntry.rebuild_batches() fills per batch.
+REBUILD_BATCH = 1000
+
+# Relationships User.load_relations() preloads as id sets. Followers and
+# incoming requests are left out: they can be huge and are only ever
+# checked one at a time. Blocks have their own index (see Block).
+RELATION_KINDS = ('following', 'requested')
+
+# Seconds a user's cached block sets are trusted. Blocks made in this
+# process are picked up right away; ones made in other workers may take
+# this long.
+BLOCKS_TTL = 60
+
+# user id -> (ids of users it blocks, ids of users blocking it)
+blocks_index = TTLCache(ttl=BLOCKS_TTL)
 
 
 class Follow(db.Model):
@@ -26,6 +58,14 @@ class Follow(db.Model):
         primary_key=True,
     )
 
+    # The primary key serves "who follows X"; this serves "who does X follow".
+    __table_args__ = (
+        db.Index('ix_follows_follower_followee', follower, followee),
+    )
+
+
+follow_graph = FollowGraph(db, Follow)
+
 
 class Block(db.Model):
     """blocker user <-> blockee user"""
@@ -44,6 +84,80 @@ class Block(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        db.Index('ix_blocks_blocker_blockee', blocker, blockee),
+    )
+
+    @classmethod
+    def sets_for(cls, user_id):
+        """(ids of users `user_id` blocks, ids of users blocking `user_id`).
+
+        Both are frozensets, cached in blocks_index, so checking a block is
+        a set lookup rather than a query.
+        """
+
+        sets = blocks_index.get(user_id)
+        if sets is None:
+            blocking, blocked_by = set(), set()
+            rows = (db.session
+                    .query(cls.blocker, cls.blockee)
+                    .filter(db.or_(cls.blocker == user_id,
+                                   cls.blockee == user_id)))
+            for blocker, blockee in rows:
+                if blocker == user_id:
+                    blocking.add(blockee)
+                else:
+                    blocked_by.add(blocker)
+
+            sets = (frozenset(blocking), frozenset(blocked_by))
+            blocks_index.set(user_id, sets)
+
+        return sets
+
+    @classmethod
+    def hidden_from(cls, user_id):
+        """Ids of users `user_id` blocks or is blocked by."""
+
+        blocking, blocked_by = cls.sets_for(user_id)
+        return blocking | blocked_by
+
+    @classmethod
+    def not_between(cls, user_id, other_user_id):
+        """SQL condition: no block either way between `user_id` and
+        `other_user_id` (usually a column of the outer query).
+
+        Two NOT EXISTS anti-joins, served by the primary key and
+        ix_blocks_blocker_blockee.
+        """
+
+        return db.and_(
+            ~db.exists().where(db.and_(cls.blocker == user_id,
+                                       cls.blockee == other_user_id)),
+            ~db.exists().where(db.and_(cls.blockee == user_id,
+                                       cls.blocker == other_user_id)),
+        )
+
+    @classmethod
+    def changed(cls, *user_ids):
+        """Drop the cached block sets of `user_ids`, whose blocks changed.
+
+        They're dropped again when the transaction ends, so other requests
+        can't keep sets read before the change was committed.
+        """
+
+        for user_id in user_ids:
+            blocks_index.delete(user_id)
+        db.session.info.setdefault('changed_blocks', set()).update(user_ids)
+
+
+def forget_changed_blocks(session):
+    for user_id in session.info.pop('changed_blocks', ()):
+        blocks_index.delete(user_id)
+
+
+event.listen(db.session, 'after_commit', forget_changed_blocks)
+event.listen(db.session, 'after_rollback', forget_changed_blocks)
+
 
 class Request(db.Model):
     """ follow request from sender to recipient """
@@ -62,6 +176,10 @@ class Request(db.Model):
         primary_key=True
     )
 
+    __table_args__ = (
+        db.Index('ix_requests_recipient_sender', recipient, sender),
+    )
+
 
 class Like(db.Model):
     """Connection of a message <-> user"""
@@ -80,6 +198,316 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    # when the like was made; trending scores are decayed by it
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index('ix_likes_message_id_user_id', message_id, user_id),
+        db.Index('ix_likes_timestamp', timestamp),
+    )
+
+
+trending = Trending(db, Like)
+
+
+class Job(db.Model):
+    """A queued side effect, run later by worker.py (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+    )
+
+    # idempotency key: at most one pending job per key
+    key = db.Column(
+        db.String(200),
+    )
+
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='pending',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', status, run_at),
+        db.Index('ix_jobs_key', key),
+    )
+
+
+jobs = JobQueue(db, Job)
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's home timeline.
+
+    Rows are written when a message is posted (fan-out on write) and
+    repaired when follows change, so reading a timeline is a single
+    range scan over (user_id, timestamp).
+    """
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp',
+                 user_id, timestamp.desc(), message_id.desc()),
+    )
+
+    @classmethod
+    def fan_out(cls, message):
+        """Deliver `message` to its author and every follower of its author.
+
+        The author's own timeline gets it right away; followers' timelines
+        are filled by a queued job. The message must already be flushed so
+        it has an id and timestamp.
+        """
+
+        db.session.add(cls(user_id=message.user_id,
+                           message_id=message.id,
+                           author_id=message.user_id,
+                           timestamp=message.timestamp))
+        jobs.enqueue('deliver_message', key=f"deliver_message:{message.id}",
+                     message_id=message.id)
+
+    @classmethod
+    def deliver(cls, message_id):
+        """Add message `message_id` to its author's followers' timelines.
+
+        Skips timelines that already have it (e.g. from a backfill), and
+        does nothing if the message has been deleted since.
+        """
+
+        message = Message.query.get(message_id)
+        if message is None:
+            return
+
+        already_delivered = (db.session
+                             .query(cls.user_id)
+                             .filter(cls.message_id == message.id))
+        followers = (db.session
+                     .query(Follow.follower,
+                            db.literal(message.id),
+                            db.literal(message.user_id),
+                            db.literal(message.timestamp))
+                     .filter(Follow.followee == message.user_id,
+                             Follow.follower.notin_(already_delivered)))
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                followers))
+
+    @classmethod
+    def backfill(cls, user_id, author_id, limit=TIMELINE_BACKFILL):
+        """Copy the most recent messages of `author_id` into a timeline.
+
+        Called when `user_id` starts following `author_id`.
+        """
+
+        already_delivered = (db.session
+                             .query(cls.message_id)
+                             .filter(cls.user_id == user_id,
+                                     cls.author_id == author_id))
+        recent = (db.session
+                  .query(db.literal(user_id),
+                         Message.id,
+                         Message.user_id,
+                         Message.timestamp)
+                  .filter(Message.user_id == author_id,
+                          Message.id.notin_(already_delivered))
+                  .order_by(Message.timestamp.desc())
+                  .limit(limit))
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                recent))
+
+    @classmethod
+    def backfill_many(cls, user_ids, author_id, limit=TIMELINE_BACKFILL):
+        """Like backfill(), for every user in the `user_ids` subquery at
+        once, in a single INSERT ... SELECT.
+
+        `user_ids` is a subquery with a `user_id` column.
+        """
+
+        recent = (db.session
+                  .query(Message.id, Message.user_id, Message.timestamp)
+                  .filter(Message.user_id == author_id)
+                  .order_by(Message.timestamp.desc())
+                  .limit(limit)
+                  .subquery())
+        rows = (db.session
+                .query(user_ids.c.user_id,
+                       recent.c.id,
+                       recent.c.user_id,
+                       recent.c.timestamp)
+                .join(recent, db.true())
+                .filter(~db.exists().where(db.and_(
+                    cls.user_id == user_ids.c.user_id,
+                    cls.message_id == recent.c.id))))
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                rows))
+
+    @classmethod
+    def purge(cls, user_id, author_id):
+        """Remove every message by `author_id` from the timeline of `user_id`."""
+
+        (cls.query
+         .filter(cls.user_id == user_id, cls.author_id == author_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls, limit=TIMELINE_BACKFILL):
+        """Recreate every timeline from the follows and messages tables.
+
+        Each timeline keeps at most `limit` messages per followed author.
+        Runs in the caller's transaction; for a big database use
+        rebuild_batches() and commit in between.
+        """
+
+        for _ in cls.rebuild_batches(limit=limit):
+            pass
+
+    @classmethod
+    def rebuild_batches(cls, batch_size=REBUILD_BATCH,
+                        limit=TIMELINE_BACKFILL):
+        """Recreate every timeline, `batch_size` users' worth at a time.
+
+        A generator: yields the last user id done after each batch, so the
+        caller can commit and each statement stays bounded.
+        """
+
+        last_id = (db.session
+                   .query(db.func.max(User.id))
+                   .execution_options(include_deleted=True)
+                   .scalar()) or 0
+
+        for first_id in range(1, last_id + 1, batch_size):
+            cls.rebuild_range(first_id, first_id + batch_size, limit)
+            yield min(first_id + batch_size - 1, last_id)
+
+    @classmethod
+    def rebuild_range(cls, first_id, stop_id, limit=TIMELINE_BACKFILL):
+        """Recreate the timelines of users `first_id` to `stop_id` - 1."""
+
+        (cls.query
+         .filter(cls.user_id >= first_id, cls.user_id < stop_id)
+         .delete(synchronize_session=False))
+
+        audience = (db.session
+                    .query(Follow.follower.label('user_id'),
+                           Follow.followee.label('author_id'))
+                    .filter(Follow.follower >= first_id,
+                            Follow.follower < stop_id)
+                    .union_all(db.session
+                               .query(User.id.label('user_id'),
+                                      User.id.label('author_id'))
+                               .filter(User.id >= first_id,
+                                       User.id < stop_id))
+                    .subquery())
+        ranked = (db.session
+                  .query(audience.c.user_id,
+                         Message.id.label('message_id'),
+                         Message.user_id.label('author_id'),
+                         Message.timestamp,
+                         db.func.row_number().over(
+                             partition_by=(audience.c.user_id,
+                                           Message.user_id),
+                             order_by=Message.timestamp.desc(),
+                         ).label('position'))
+                  .join(Message, Message.user_id == audience.c.author_id)
+                  .subquery())
+        rows = (db.session
+                .query(ranked.c.user_id,
+                       ranked.c.message_id,
+                       ranked.c.author_id,
+                       ranked.c.timestamp)
+                .filter(ranked.c.position <= limit))
+
+        db.session.execute(
+            cls.__table__.insert().from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                rows))
+
+    @classmethod
+    def messages_for(cls, user_id):
+        """Query for the messages on the home timeline of `user_id`,
+        newest first.
+
+        It's ordered on (TimelineEntry.timestamp, TimelineEntry.message_id),
+        which stays on the timeline index; page it on the same columns.
+        Joining on the timestamp too lets PostgreSQL look each message up
+        in just its own monthly partition (see partitions.py).
+        """
+
+        return (Message
+                .query
+                .join(cls, db.and_(cls.message_id == Message.id,
+                                   cls.timestamp == Message.timestamp))
+                .filter(cls.user_id == user_id,
+                        Block.not_between(user_id, cls.author_id))
+                .order_by(cls.timestamp.desc(), cls.message_id.desc()))
+
+
 class User(db.Model):
     """User in the system."""
 
@@ -135,6 +563,53 @@ class User(db.Model):
         default=False
     )
 
+    # When the profile (username, images, bio...) was last edited. Cached
+    # user fragments are keyed on it, so it must be bumped on every edit.
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
+    # Set when the account is deleted. Deleted users and their messages
+    # are left out of every query (see hide_deleted_users) until the
+    # purge_user job has removed them.
+    deleted_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    # Denormalized counts shown in stats.html. They are kept in step by the
+    # methods below and can be rebuilt with recount_counters().
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    liked_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message',
                                order_by='Message.timestamp.desc()',
                                cascade="all,delete",
@@ -178,37 +653,437 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    def load_relations(self):
+        """Load the ids of users this user follows or has requested to
+        follow, in a single query.
+
+        Once loaded, is_following and is_pending_follow answer from these
+        sets for the rest of the request. Call this before rendering a page
+        with many user cards.
+        """
+
+        relations = (
+            db.session.query(db.literal('following'), Follow.followee)
+            .filter(Follow.follower == self.id)
+            .union_all(
+                db.session.query(db.literal('requested'), Request.recipient)
+                .filter(Request.sender == self.id),
+            ))
+
+        self._relation_ids = {kind: set() for kind in RELATION_KINDS}
+        for kind, user_id in relations:
+            self._relation_ids[kind].add(user_id)
+
+    def suggested_follows(self, limit=5):
+        """Users this user may want to follow, from the follow graph.
+
+        Returns [(user, [up to 2 followees who follow them], how many
+        followees follow them), ...], best first. Leaves out users blocked
+        either way or already requested.
+        """
+
+        if not hasattr(self, '_relation_ids'):
+            self.load_relations()
+        exclude = self._relation_ids['requested'] | Block.hidden_from(self.id)
+
+        ranked = follow_graph.suggestions(self.id, limit, exclude)
+        ids = set()
+        for user_id, followed_by in ranked:
+            ids.add(user_id)
+            ids.update(followed_by[:2])
+        users = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+
+        return [(users[user_id],
+                 [users[id] for id in followed_by[:2] if id in users],
+                 len(followed_by))
+                for user_id, followed_by in ranked
+                if user_id in users]
+
+    def load_likes(self, messages):
+        """Load which of `messages` this user has liked, in one query.
+
+        Afterwards has_liked() answers from memory for those messages.
+        Messages already loaded aren't asked about again.
+        """
+
+        if not hasattr(self, '_checked_like_ids'):
+            self._liked_ids = set()
+            self._checked_like_ids = set()
+
+        message_ids = [message.id for message in messages
+                       if message.id not in self._checked_like_ids]
+        if not message_ids:
+            return
+
+        liked = (db.session
+                 .query(Like.message_id)
+                 .filter(Like.user_id == self.id,
+                         Like.message_id.in_(message_ids)))
+
+        self._liked_ids.update(message_id for (message_id,) in liked)
+        self._checked_like_ids.update(message_ids)
+
+    def has_liked(self, message):
+        """Has this user liked `message`?"""
+
+        if message.id in getattr(self, '_checked_like_ids', ()):
+            return message.id in self._liked_ids
+
+        return db.session.query(db.exists().where(db.and_(
+            Like.user_id == self.id,
+            Like.message_id == message.id,
+        ))).scalar()
+
+    def _is_related(self, kind, other_user, *criteria):
+        """Check one relationship to `other_user`.
+
+        Answers from the sets filled by load_relations() when they are
+        loaded, otherwise with an EXISTS query on the association table.
+        """
+
+        relation_ids = getattr(self, '_relation_ids', None)
+        if relation_ids is not None and kind in relation_ids:
+            return other_user.id in relation_ids[kind]
+
+        return db.session.query(db.exists().where(db.and_(*criteria))).scalar()
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return self._is_related('followers', other_user,
+                                Follow.followee == self.id,
+                                Follow.follower == other_user.id)
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return self._is_related('following', other_user,
+                                Follow.follower == self.id,
+                                Follow.followee == other_user.id)
 
     def is_pending_follow(self, other_user):
         """ Is this user waiting for other_user to accept follow request? """
-        found_user_list = [user for user in self.following_requests if user == other_user]
-        return len(found_user_list) == 1
+        return self._is_related('requested', other_user,
+                                Request.sender == self.id,
+                                Request.recipient == other_user.id)
 
     def has_pending_follower(self, other_user):
         """ Is other_user waiting for this user to accept follow request? """
-        found_user_list = [user for user in self.follower_requests if user == other_user]
-        return len(found_user_list) == 1
+        return self._is_related('requesters', other_user,
+                                Request.recipient == self.id,
+                                Request.sender == other_user.id)
 
     def is_blocking(self, other_user):
         """ Is this user blocking the other_user? """
-        blocked_user_list = [user for user in self.blocked_users if user == other_user]
-        return len(blocked_user_list) == 1
+        return other_user.id in Block.sets_for(self.id)[0]
 
     def is_blocked(self, other_user):
         """ Is this user blocked by other_user? """
-        blocked_user_list = [user for user in other_user.blocked_users if user == self]
-        return len(blocked_user_list) == 1
+        return other_user.id in Block.sets_for(self.id)[1]
+
+    def post_message(self, text):
+        """Post a new message and deliver it to followers' timelines."""
+
+        message = Message(text=text, user_id=self.id)
+        db.session.add(message)
+        db.session.flush()
+
+        increment(User, User.id == self.id, message_count=1)
+        TimelineEntry.fan_out(message)
+
+        return message
+
+    def follow(self, other_user):
+        """Start following `other_user`. Does nothing if already following."""
+
+        if self.is_following(other_user):
+            return
+
+        db.session.add(Follow(follower=self.id, followee=other_user.id))
+        db.session.flush()
+        follow_graph.record(db.session, 'add', self.id, other_user.id)
+
+        increment(User, User.id == self.id, following_count=1)
+        increment(User, User.id == other_user.id, follower_count=1)
+        TimelineEntry.backfill(self.id, other_user.id)
+
+    def unfollow(self, other_user):
+        """Stop following `other_user`. Does nothing if not following."""
+
+        removed = (Follow.query
+                   .filter(Follow.follower == self.id,
+                           Follow.followee == other_user.id)
+                   .delete(synchronize_session=False))
+
+        if removed:
+            follow_graph.record(db.session, 'remove', self.id, other_user.id)
+            increment(User, User.id == self.id, following_count=-1)
+            increment(User, User.id == other_user.id, follower_count=-1)
+            jobs.enqueue('purge_timeline',
+                         key=f"purge_timeline:{self.id}:{other_user.id}",
+                         user_id=self.id, author_id=other_user.id)
+
+    def request_follow(self, other_user):
+        """Ask to follow the private account of `other_user`.
+
+        Returns whether a new request was made.
+        """
+
+        if self.is_pending_follow(other_user):
+            return False
+
+        db.session.add(Request(sender=self.id, recipient=other_user.id))
+        return True
+
+    def accept_follow_request(self, sender):
+        """Turn the follow request from `sender` into a follow.
+
+        Returns False if there was no such request.
+        """
+
+        removed = (Request.query
+                   .filter(Request.sender == sender.id,
+                           Request.recipient == self.id)
+                   .delete(synchronize_session=False))
+
+        if not removed:
+            return False
+
+        sender.follow(self)
+        return True
+
+    def _pending_requests(self, sender_ids):
+        """Condition for this user's requests from `sender_ids` (all if
+        None), leaving out senders whose account is being deleted."""
+
+        # the deleted_at loader criteria don't reach these core statements
+        live_sender = db.exists().where(db.and_(User.id == Request.sender,
+                                                User.deleted_at.is_(None)))
+        pending = db.and_(Request.recipient == self.id, live_sender)
+        if sender_ids is not None:
+            pending = db.and_(pending, Request.sender.in_(sender_ids))
+        return pending
+
+    def accept_follow_requests(self, sender_ids=None):
+        """Accept the follow requests from `sender_ids`, or all of them.
+
+        Done set-based whatever the number of requests: the follows are
+        INSERT ... SELECTed from the requests, counters and timelines are
+        updated with one statement each, then the requests are deleted.
+        Returns the ids of the new followers.
+        """
+
+        pending = self._pending_requests(sender_ids)
+        new_followers = db.and_(pending, ~db.exists().where(db.and_(
+            Follow.follower == Request.sender,
+            Follow.followee == self.id)))
+        senders = db.session.query(Request.sender).filter(new_followers)
+
+        accepted = [sender for (sender,) in senders]
+        if accepted:
+            # these read the requests, so run them before the follows exist
+            increment(User, User.id.in_(senders), following_count=1)
+            TimelineEntry.backfill_many(
+                senders.with_entities(Request.sender.label('user_id'))
+                .subquery(),
+                self.id)
+            db.session.execute(
+                Follow.__table__.insert().from_select(
+                    ['follower', 'followee'],
+                    senders.add_columns(db.literal(self.id))))
+            increment(User, User.id == self.id, follower_count=len(accepted))
+
+        (Request.query
+         .filter(pending)
+         .delete(synchronize_session=False))
+
+        for sender in accepted:
+            follow_graph.record(db.session, 'add', sender, self.id)
+
+        return accepted
+
+    def decline_follow_requests(self, sender_ids=None):
+        """Delete the follow requests from `sender_ids`, or all of them.
+
+        Returns how many were deleted.
+        """
+
+        return (Request.query
+                .filter(self._pending_requests(sender_ids))
+                .delete(synchronize_session=False))
+
+    def block(self, other_user):
+        """Block `other_user`, dropping follows and requests either way."""
+
+        insert_ignoring_conflicts(Block, blocker=self.id,
+                                  blockee=other_user.id)
+        Block.changed(self.id, other_user.id)
+
+        self.unfollow(other_user)
+        other_user.unfollow(self)
+
+        (Request.query
+         .filter(db.or_(
+             db.and_(Request.sender == self.id,
+                     Request.recipient == other_user.id),
+             db.and_(Request.sender == other_user.id,
+                     Request.recipient == self.id)))
+         .delete(synchronize_session=False))
+
+    def unblock(self, other_user):
+        """Stop blocking `other_user`."""
+
+        (Block.query
+         .filter(Block.blocker == self.id, Block.blockee == other_user.id)
+         .delete(synchronize_session=False))
+        Block.changed(self.id, other_user.id)
+
+    def like(self, message):
+        """Like `message`. Does nothing if already liked.
+
+        Returns whether the like was added. Safe to call twice at once:
+        the insert skips a like that is already there, so the counters are
+        only bumped once.
+        """
+
+        liked_at = datetime.utcnow()
+        if not insert_ignoring_conflicts(Like, user_id=self.id,
+                                         message_id=message.id,
+                                         timestamp=liked_at):
+            return False
+
+        increment(User, User.id == self.id, liked_count=1)
+        increment(Message, Message.id == message.id, like_count=1)
+        trending.record(db.session, message.id, 1, liked_at)
+
+        if hasattr(self, '_checked_like_ids'):
+            self._checked_like_ids.add(message.id)
+            self._liked_ids.add(message.id)
+        return True
+
+    def unlike(self, message):
+        """Take back a like of `message`. Does nothing if not liked.
+
+        Returns whether a like was removed.
+        """
+
+        liked = Like.query.filter(Like.user_id == self.id,
+                                  Like.message_id == message.id)
+        liked_at = liked.with_entities(Like.timestamp).scalar()
+
+        removed = liked.delete(synchronize_session=False)
+
+        if removed:
+            increment(User, User.id == self.id, liked_count=-1)
+            increment(Message, Message.id == message.id, like_count=-1)
+            trending.record(db.session, message.id, -1, liked_at)
+
+        if hasattr(self, '_checked_like_ids'):
+            self._checked_like_ids.add(message.id)
+            self._liked_ids.discard(message.id)
+        return bool(removed)
+
+    def release_counters(self):
+        """Take this user out of everyone else's counters.
+
+        Call before deleting the user: the database cascade removes their
+        follows, likes and messages, but not the counts that include them.
+        """
+
+        follower_ids = (db.session
+                        .query(Follow.follower)
+                        .filter(Follow.followee == self.id))
+        followee_ids = (db.session
+                        .query(Follow.followee)
+                        .filter(Follow.follower == self.id))
+        liked_message_ids = (db.session
+                             .query(Like.message_id)
+                             .filter(Like.user_id == self.id))
+
+        increment(User, User.id.in_(follower_ids), following_count=-1)
+        increment(User, User.id.in_(followee_ids), follower_count=-1)
+        increment(Message, Message.id.in_(liked_message_ids), like_count=-1)
+
+        own_message_likes = (db.session
+                             .query(Like.user_id)
+                             .join(Message, Message.id == Like.message_id)
+                             .filter(Message.user_id == self.id))
+        likes_of_own_messages = (db.session
+                                 .query(db.func.count())
+                                 .select_from(Like)
+                                 .join(Message, Message.id == Like.message_id)
+                                 .filter(Message.user_id == self.id,
+                                         Like.user_id == User.id)
+                                 .scalar_subquery())
+        (User.query
+         .filter(User.id.in_(own_message_likes))
+         .update({User.liked_count:
+                  User.liked_count - likes_of_own_messages},
+                 synchronize_session=False))
+
+    def schedule_deletion(self):
+        """Delete this account.
+
+        It's soft-deleted right away: marked deleted_at, which hides it
+        and its messages everywhere, and taken out of everyone else's
+        counters. The purge_user job then removes its messages, likes,
+        follows, blocks, requests and timeline entries a batch at a time,
+        and the row itself last.
+        """
+
+        if self.deleted_at is not None:
+            return
+
+        self.deleted_at = datetime.utcnow()
+        self.release_counters()
+
+        # pending requests either way would otherwise still be accepted
+        # into follows that the purge then deletes without a recount
+        (Request.query
+         .filter(db.or_(Request.sender == self.id,
+                        Request.recipient == self.id))
+         .delete(synchronize_session=False))
+        jobs.enqueue('purge_user', key=f"purge_user:{self.id}",
+                     user_id=self.id)
+
+        # imported here: current_user imports this module
+        from current_user import forget_current_user
+        forget_current_user(self.id)
+
+    def purge_batch(self, limit=PURGE_BATCH):
+        """Delete up to `limit` rows of each table that refer to this
+        (soft-deleted) user, or the user's row once nothing is left.
+
+        Returns whether there is more to delete.
+        """
+
+        own_messages = (db.session
+                        .query(Message.id)
+                        .filter(Message.user_id == self.id))
+
+        deleted = sum(delete_batch(model, criterion, limit) for model, criterion in [
+            (TimelineEntry, db.or_(TimelineEntry.user_id == self.id,
+                                   TimelineEntry.author_id == self.id)),
+            (Like, db.or_(Like.user_id == self.id,
+                          Like.message_id.in_(own_messages))),
+            (Follow, db.or_(Follow.follower == self.id,
+                            Follow.followee == self.id)),
+            (Block, db.or_(Block.blocker == self.id,
+                           Block.blockee == self.id)),
+            (Request, db.or_(Request.sender == self.id,
+                             Request.recipient == self.id)),
+        ])
+        # messages last, once nothing refers to them
+        deleted += delete_batch(Message, Message.user_id == self.id, limit)
+
+        if deleted:
+            return True
+
+        (User.query
+         .execution_options(include_deleted=True)
+         .filter(User.id == self.id)
+         .delete(synchronize_session=False))
+        return False
 
     @classmethod
     def signup(cls, username, email, password, image_url, is_admin):
@@ -217,7 +1092,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -238,17 +1113,51 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with a different work factor than the
+        one configured now, it is replaced with a fresh hash; the caller's
+        commit saves it.
+
+        Raises PasswordHasherBusy if too many hashes are already queued.
         """
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_hasher.check(user.password, password)
             if is_auth:
+                if password_hasher.needs_rehash(user.password):
+                    user.password = password_hasher.hash(password)
                 return user
 
         return False
 
 
+# Text searched by the full-text profile search (see search.py). The query
+# must use this exact expression for PostgreSQL to use the index on it.
+USER_PROFILE_DOCUMENT = ("to_tsvector('english', coalesce(bio, '') "
+                         "|| ' ' || coalesce(location, ''))")
+
+# Search indexes only PostgreSQL supports. Other databases (e.g. SQLite in
+# development) skip them and search.py falls back to plain LIKE.
+USER_SEARCH_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+    "ON users USING gist (username gist_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_prefix "
+    "ON users (username text_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_profile_fts "
+    f"ON users USING gin (({USER_PROFILE_DOCUMENT}))",
+]
+
+event.listen(
+    User.__table__, 'before_create',
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    .execute_if(dialect='postgresql'))
+for statement in USER_SEARCH_INDEXES:
+    event.listen(
+        User.__table__, 'after_create',
+        DDL(statement).execute_if(dialect='postgresql'))
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -267,7 +1176,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -276,11 +1185,221 @@ class Message(db.Model):
         nullable=False,
     )
 
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     likers = db.relationship('User', secondary="likes")
 
+    # A user's messages, newest first (profiles and timeline backfill).
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp',
+                 user_id, timestamp.desc(), id.desc()),
+    )
+
     def __repr__(self):
         return f"<Message #{self.id}: {self.text}, {self.user_id}>"
 
+    @classmethod
+    def trending(cls, limit=20, viewer_id=None):
+        """The `limit` most liked messages lately that `viewer_id` may see,
+        best first, as [(message, decayed like count), ...].
+
+        Ranked by the in-memory trending scores (see trending.py); only
+        the top few are loaded. Messages of private accounts the viewer
+        doesn't follow, and of accounts blocking or blocked by the viewer,
+        are left out.
+        """
+
+        # load a few extra, as some may be hidden from the viewer
+        top = trending.top(limit * 2)
+
+        query = (cls.query
+                 .options(db.contains_eager(cls.user))
+                 .join(cls.user)
+                 .filter(cls.id.in_([message_id for message_id, _ in top])))
+        if viewer_id is None:
+            query = query.filter(User.is_private.isnot(True))
+        else:
+            follows = db.exists().where(db.and_(Follow.follower == viewer_id,
+                                                Follow.followee == cls.user_id))
+            query = query.filter(db.or_(User.is_private.isnot(True),
+                                        cls.user_id == viewer_id,
+                                        follows),
+                                 Block.not_between(viewer_id, cls.user_id))
+
+        messages = {message.id: message for message in query}
+        return [(messages[message_id], score)
+                for message_id, score in top
+                if message_id in messages][:limit]
+
+    def destroy(self):
+        """Delete this message and take it out of every counter."""
+
+        liker_ids = (db.session
+                     .query(Like.user_id)
+                     .filter(Like.message_id == self.id))
+        increment(User, User.id.in_(liker_ids), liked_count=-1)
+        increment(User, User.id == self.user_id, message_count=-1)
+
+        # no foreign keys cascade these once messages is partitioned
+        (Like.query
+         .filter(Like.message_id == self.id)
+         .delete(synchronize_session=False))
+        (TimelineEntry.query
+         .filter(TimelineEntry.message_id == self.id)
+         .delete(synchronize_session=False))
+
+        db.session.delete(self)
+
+
+def insert_ignoring_conflicts(model, **values):
+    """INSERT a `model` row with `values` unless one with the same key is
+    already there, in a single statement. Returns whether it was inserted.
+
+    Uses INSERT ... ON CONFLICT DO NOTHING, which PostgreSQL and SQLite
+    both support.
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        insert = postgresql.insert
+    else:
+        insert = sqlite.insert
+
+    statement = insert(model.__table__).values(**values).on_conflict_do_nothing()
+    return db.session.execute(statement).rowcount == 1
+
+
+def delete_batch(model, criterion, limit):
+    """DELETE up to `limit` rows of `model` matching `criterion`, by
+    primary key, so each statement only locks a bounded number of rows.
+
+    Returns how many were deleted.
+    """
+
+    key = list(model.__table__.primary_key.columns)
+    rows = (db.session
+            .query(*key)
+            .filter(criterion)
+            .limit(limit)
+            .execution_options(include_deleted=True)
+            .all())
+    if not rows:
+        return 0
+
+    if len(key) == 1:
+        chosen = key[0].in_([row[0] for row in rows])
+    else:
+        chosen = tuple_(*key).in_([tuple(row) for row in rows])
+
+    return (model.query
+            .filter(chosen)
+            .delete(synchronize_session=False))
+
+
+def increment(model, criterion, **deltas):
+    """Add `deltas` to counter columns of the `model` rows matching
+    `criterion`, as a single UPDATE inside the current transaction.
+
+    e.g. increment(User, User.id == 1, follower_count=1)
+    """
+
+    (model.query
+     .filter(criterion)
+     .update({getattr(model, column): getattr(model, column) + delta
+              for column, delta in deltas.items()},
+             synchronize_session=False))
+
+
+def recount_counters():
+    """Recompute every denormalized counter from the underlying tables."""
+
+    def count(table, criterion):
+        return (db.session
+                .query(db.func.count())
+                .select_from(table)
+                .filter(criterion)
+                .scalar_subquery())
+
+    (User.query
+     .update({
+         User.message_count: count(Message, Message.user_id == User.id),
+         User.following_count: count(Follow, Follow.follower == User.id),
+         User.follower_count: count(Follow, Follow.followee == User.id),
+         User.liked_count: count(Like, Like.user_id == User.id),
+     }, synchronize_session=False))
+    (Message.query
+     .update({Message.like_count: count(Like, Like.message_id == Message.id)},
+             synchronize_session=False))
+
+
+@jobs.handler('deliver_message')
+def deliver_message(message_id):
+    TimelineEntry.deliver(message_id)
+
+
+@jobs.handler('purge_timeline')
+def purge_timeline(user_id, author_id):
+    # they may have followed again since the job was queued
+    following = (db.session
+                 .query(db.exists().where(db.and_(
+                     Follow.follower == user_id,
+                     Follow.followee == author_id)))
+                 .scalar())
+    if not following:
+        TimelineEntry.purge(user_id, author_id)
+
+
+@jobs.handler('purge_user')
+def purge_user(user_id):
+    user = (User.query
+            .execution_options(include_deleted=True)
+            .filter(User.id == user_id)
+            .first())
+    if user is None or user.deleted_at is None:
+        return
+
+    if user.purge_batch():
+        # the rest in a later job, so no transaction runs for long
+        jobs.enqueue('purge_user', user_id=user_id)
+
+
+@jobs.handler('delete_user')
+def delete_user(user_id):
+    # queued before accounts were soft-deleted
+    user = User.query.get(user_id)
+    if user is not None:
+        user.schedule_deletion()
+
+
+# an alias, so it's never correlated with a users table in the outer query
+deleted_authors = User.__table__.alias('deleted_authors')
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def hide_deleted_users(state):
+    """Leave soft-deleted users, and messages by them, out of ORM queries.
+
+    Opt out with .execution_options(include_deleted=True).
+    """
+
+    if not state.is_select or state.execution_options.get('include_deleted'):
+        return
+
+    state.statement = state.statement.options(
+        orm.with_loader_criteria(User, User.deleted_at.is_(None),
+                                 include_aliases=True),
+        orm.with_loader_criteria(
+            Message,
+            lambda cls: ~db.exists().where(db.and_(
+                deleted_authors.c.id == cls.user_id,
+                deleted_authors.c.deleted_at.isnot(None))),
+            include_aliases=True),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -290,3 +1409,8 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    init_database(app)
+    password_hasher.init_app(app)
+    jobs.init_app(app)
+    follow_graph.init_app(app)
+    trending.init_app(app)
@@ -0,0 +1,142 @@
+"""Live notifications over server-sent events (SSE).
+
+The notifications page opens an EventSource on /notifications/stream.
+Views publish events for a user (e.g. a new follow request) once they've
+committed, and every open stream of that user gets them right away. The
+page doesn't need reloading, and nothing polls the database.
+
+The broker is in-process: a stream only gets events published by the
+worker process it's connected to. Each stream holds a request thread for
+as long as it's open, so the app needs a threaded or async server, and
+at most NOTIFY_MAX_CONNECTIONS streams are allowed per process. With
+threaded workers keep that well below the thread count, or open streams
+leave no threads for other requests; app.py defaults it to half of them.
+
+Settings (read from app.config by init_app):
+
+- NOTIFY_MAX_CONNECTIONS: open streams allowed per process (default 8)
+- NOTIFY_QUEUE_SIZE: events kept for a slow stream (default 20); past
+  that the stream is told to reload and closed
+- NOTIFY_HEARTBEAT: seconds between keep-alive comments (default 15)
+"""
+
+import json
+import queue
+from collections import defaultdict
+from threading import Lock
+
+# tells a stream whose queue overflowed to reload the page
+OVERFLOW = object()
+
+
+class NotificationBrokerFull(Exception):
+    """Too many notification streams are open in this process."""
+
+
+class Subscription:
+    """One open stream of `user_id`'s notifications."""
+
+    def __init__(self, broker, user_id, queue_size):
+        self.broker = broker
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=queue_size)
+
+    def put(self, event):
+        """Queue `event`; on overflow, queue OVERFLOW in its place."""
+
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            with self.queue.mutex:
+                self.queue.queue.clear()
+                self.queue.queue.append(OVERFLOW)
+                self.queue.not_empty.notify()
+
+    def stream(self):
+        """Yield the SSE text for queued events and heartbeats.
+
+        Ends (and unsubscribes) when the client goes away or the queue
+        overflowed.
+        """
+
+        try:
+            yield f"retry: {self.broker.retry_ms}\n\n"
+            while True:
+                try:
+                    event = self.queue.get(timeout=self.broker.heartbeat)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+
+                if event is OVERFLOW:
+                    yield "event: reload\ndata: {}\n\n"
+                    return
+
+                kind, data = event
+                yield f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            self.broker.unsubscribe(self)
+
+
+class NotificationBroker:
+    """In-process pub/sub of notification events per user."""
+
+    def __init__(self, max_connections=8, queue_size=20, heartbeat=15):
+        self.max_connections = max_connections
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.retry_ms = 5000
+        self._subscriptions = defaultdict(set)
+        self._count = 0
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """Apply the NOTIFY_* settings of `app`."""
+
+        self.max_connections = app.config.setdefault(
+            'NOTIFY_MAX_CONNECTIONS', 8)
+        self.queue_size = app.config.setdefault('NOTIFY_QUEUE_SIZE', 20)
+        self.heartbeat = app.config.setdefault('NOTIFY_HEARTBEAT', 15)
+
+    def subscribe(self, user_id):
+        """Open a Subscription for `user_id`.
+
+        Raises NotificationBrokerFull past NOTIFY_MAX_CONNECTIONS.
+        """
+
+        with self._lock:
+            if self._count >= self.max_connections:
+                raise NotificationBrokerFull()
+            subscription = Subscription(self, user_id, self.queue_size)
+            self._subscriptions[user_id].add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions and subscription in subscriptions:
+                subscriptions.discard(subscription)
+                self._count -= 1
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def publish(self, user_id, kind, **data):
+        """Send a `kind` event with `data` to every stream of `user_id`.
+
+        Call after committing: the event is delivered right away.
+        """
+
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.put((kind, data))
+
+    @property
+    def connections(self):
+        """How many streams are open in this process."""
+
+        return self._count
+
+
+notifications = NotificationBroker()
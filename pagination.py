@@ -0,0 +1,86 @@
+"""Keyset (cursor) pagination for Warbler listings.
+
+Message lists are ordered newest first on (timestamp, id) and user lists
+are ordered on id. Each page is read with a range condition on those
+columns rather than an OFFSET, so fetching the 50th page costs the same
+as fetching the first.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+MESSAGES_PER_PAGE = 20
+USERS_PER_PAGE = 30
+
+CURSOR_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def encode_cursor(timestamp, id):
+    """Make an opaque cursor string for the message at (timestamp, id)."""
+
+    return f"{timestamp.strftime(CURSOR_TIMESTAMP_FORMAT)}_{id}"
+
+
+def decode_cursor(cursor):
+    """Turn a cursor string back into (timestamp, id).
+
+    Returns None if the cursor is missing or malformed, which callers
+    treat as "start from the first page".
+    """
+
+    try:
+        timestamp, id = cursor.rsplit("_", 1)
+        return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def paginate_messages(query, before, timestamp_col, id_col,
+                      per_page=MESSAGES_PER_PAGE):
+    """Get one page of messages, newest first.
+
+    `query` must select Message objects (or rows with their id and
+    timestamp); `timestamp_col` and `id_col` are
+    the columns it is ordered on (the message's own columns, or the copies
+    on a timeline entry). Returns (messages, next_cursor); next_cursor is
+    None on the last page.
+    """
+
+    position = decode_cursor(before)
+    if position:
+        query = query.filter(tuple_(timestamp_col, id_col) < tuple_(*position))
+
+    # replaces any ordering `query` came with
+    messages = (query
+                .order_by(None)
+                .order_by(timestamp_col.desc(), id_col.desc())
+                .limit(per_page + 1)
+                .all())
+
+    if len(messages) <= per_page:
+        return messages, None
+
+    messages = messages[:per_page]
+    last = messages[-1]
+    return messages, encode_cursor(last.timestamp, last.id)
+
+
+def paginate_users(query, after, id_col, per_page=USERS_PER_PAGE):
+    """Get one page of users in id order.
+
+    Returns (users, next_cursor); next_cursor is None on the last page.
+    """
+
+    try:
+        query = query.filter(id_col > int(after))
+    except (TypeError, ValueError):
+        pass
+
+    users = query.order_by(id_col).limit(per_page + 1).all()
+
+    if len(users) <= per_page:
+        return users, None
+
+    users = users[:per_page]
+    return users, str(users[-1].id)
@@ -0,0 +1,127 @@
+"""Monthly partitions of the messages table (PostgreSQL only).
+
+Migration 0008 turns `messages` into a table range-partitioned by
+timestamp, one partition per calendar month (messages_y2024m05, ...),
+plus a default partition for anything outside them. This script keeps
+partitions ready ahead of time, and detaches old ones so they can be
+archived or dropped cheaply:
+
+    python partitions.py                          # next 3 months
+    python partitions.py --ahead 6                # next 6 months
+    python partitions.py --detach-before 2023-01  # detach older months
+
+A detached partition is an ordinary table again. Its messages disappear
+from the app (timeline and like rows pointing at them are skipped by the
+joins) and it can be dumped and dropped at leisure. Run this monthly,
+from cron or a scheduler, so new messages never land in the default
+partition: a month can't be split out of it once it has rows.
+
+On other databases `messages` is a plain table and this does nothing.
+"""
+
+import argparse
+import re
+from datetime import datetime
+
+from sqlalchemy import text
+
+PARTITION_NAME = re.compile(r"^messages_y(\d{4})m(\d{2})$")
+
+
+def add_months(month, count):
+    """The first day of the month `count` months after `month`."""
+
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def partition_name(month):
+    return f"messages_y{month.year:04d}m{month.month:02d}"
+
+
+def existing_partitions(connection):
+    """{month: partition name} of the monthly partitions of messages."""
+
+    rows = connection.execute(text("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = 'messages'
+    """))
+
+    partitions = {}
+    for (name,) in rows:
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions[datetime(int(match[1]), int(match[2]), 1)] = name
+    return partitions
+
+
+def create_partition(connection, month):
+    """Create the partition for `month` unless it exists."""
+
+    connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} "
+        f"PARTITION OF messages FOR VALUES "
+        f"FROM ('{month:%Y-%m-%d}') TO ('{add_months(month, 1):%Y-%m-%d}')"))
+
+
+def create_partitions(connection, first, last):
+    """Create the partitions for every month from `first` to `last`."""
+
+    month = month_start(first)
+    while month <= last:
+        create_partition(connection, month)
+        month = add_months(month, 1)
+
+
+def detach_partitions(connection, before):
+    """Detach the partitions of months before `before`.
+
+    Returns the names of the detached tables.
+    """
+
+    detached = []
+    for month, name in sorted(existing_partitions(connection).items()):
+        if month < month_start(before):
+            connection.execute(text(
+                f"ALTER TABLE messages DETACH PARTITION {name}"))
+            detached.append(name)
+    return detached
+
+
+def main():
+    from app import db
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--ahead', type=int, default=3,
+                        help="months of partitions to create ahead")
+    parser.add_argument('--detach-before', metavar='YYYY-MM',
+                        type=lambda value: datetime.strptime(value, "%Y-%m"),
+                        help="detach partitions of months before this one")
+    args = parser.parse_args()
+
+    if db.engine.dialect.name != 'postgresql':
+        print("messages is only partitioned on PostgreSQL; nothing to do")
+        return
+
+    with db.engine.begin() as connection:
+        this_month = month_start(datetime.utcnow())
+        create_partitions(connection, this_month,
+                          add_months(this_month, args.ahead))
+
+        if args.detach_before:
+            for name in detach_partitions(connection, args.detach_before):
+                print(f"detached {name}")
+
+        for month, name in sorted(existing_partitions(connection).items()):
+            print(f"{month:%Y-%m}: {name}")
+
+
+if __name__ == '__main__':
+    main()
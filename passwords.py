@@ -0,0 +1,90 @@
+"""Password hashing on a bounded worker pool.
+
+bcrypt is deliberately slow, so a burst of logins can tie up every
+request worker. Hashes are run on a small thread pool instead (bcrypt
+releases the GIL while it works), and only a fixed number may be queued
+or running at once. Past that, callers wait up to PASSWORD_HASH_WAIT
+seconds for a slot, then get PasswordHasherBusy so the view can answer
+quickly instead of piling up.
+
+Settings (read from app.config by init_app):
+
+- BCRYPT_LOG_ROUNDS: bcrypt work factor for new hashes (default 12)
+- PASSWORD_HASH_WORKERS: threads hashing at once (default 2)
+- PASSWORD_HASH_QUEUE: extra hashes allowed to wait for a thread (default 16)
+- PASSWORD_HASH_WAIT: seconds to wait for a free slot (default 1.0)
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashes are already queued; try again later."""
+
+
+class PasswordHasher:
+    """Hash and check passwords with a Flask-Bcrypt instance, off-thread."""
+
+    def __init__(self, bcrypt, rounds=12, workers=2, queue_size=16, wait=1.0):
+        self.bcrypt = bcrypt
+        self.configure(rounds, workers, queue_size, wait)
+
+    def init_app(self, app):
+        """Apply the BCRYPT_LOG_ROUNDS / PASSWORD_HASH_* settings of `app`."""
+
+        self.configure(
+            rounds=app.config.setdefault('BCRYPT_LOG_ROUNDS', 12),
+            workers=app.config.setdefault('PASSWORD_HASH_WORKERS', 2),
+            queue_size=app.config.setdefault('PASSWORD_HASH_QUEUE', 16),
+            wait=app.config.setdefault('PASSWORD_HASH_WAIT', 1.0),
+        )
+
+    def configure(self, rounds, workers, queue_size, wait):
+        """(Re)build the pool with new settings."""
+
+        if getattr(self, '_executor', None) is not None:
+            self._executor.shutdown(wait=False)
+
+        self.rounds = rounds
+        self.wait = wait
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='bcrypt')
+        self._slots = BoundedSemaphore(workers + queue_size)
+
+    def hash(self, password):
+        """Hash `password` with the configured work factor."""
+
+        pw_hash = self._run(self.bcrypt.generate_password_hash,
+                            password, self.rounds)
+        return pw_hash.decode('UTF-8')
+
+    def check(self, pw_hash, password):
+        """Does `password` match `pw_hash`?"""
+
+        return self._run(self.bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made with a different work factor than configured?
+
+        bcrypt hashes look like "$2b$12$...", where 12 is the work factor.
+        """
+
+        try:
+            return int(pw_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def _run(self, func, *args):
+        """Run `func` on the pool and wait for its result.
+
+        Raises PasswordHasherBusy if no slot frees up in time.
+        """
+
+        if not self._slots.acquire(timeout=self.wait):
+            raise PasswordHasherBusy()
+
+        try:
+            return self._executor.submit(func, *args).result()
+        finally:
+            self._slots.release()
@@ -0,0 +1,13 @@
+"""Recompute the denormalized counters on users and messages.
+
+Run this after loading data by hand, or whenever the counts shown on
+profiles look wrong:
+
+    python recount.py
+"""
+
+from app import db
+from models import recount_counters
+
+recount_counters()
+db.session.commit()
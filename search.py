@@ -0,0 +1,94 @@
+"""User search for the directory and the JSON search API.
+
+On PostgreSQL every query here is served by an index (created in
+models.py):
+
+- username substrings: trigram GiST index, ranked by trigram distance
+- bio / location words: full-text GIN index, ranked by ts_rank
+- username prefixes (autocomplete): text_pattern_ops b-tree index
+
+Other databases fall back to LIKE scans, which is fine for development.
+"""
+
+from models import db, Block, User, USER_PROFILE_DOCUMENT
+
+SEARCH_LIMIT = 30
+AUTOCOMPLETE_LIMIT = 10
+
+
+def _is_postgresql():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def _escape_like(term):
+    """Escape LIKE wildcards so they match literally (escape char is \\)."""
+
+    return (term
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def search_users(term, limit=SEARCH_LIMIT, viewer_id=None):
+    """Find up to `limit` users matching `term`, best matches first.
+
+    Username matches come first, closest first; then users whose bio or
+    location contains the words in `term`. Users blocking or blocked by
+    `viewer_id` are left out before the limit, so they don't shorten it.
+    """
+
+    term = term.strip()
+    if not term:
+        return []
+
+    contains = f"%{_escape_like(term)}%"
+    by_username = User.query.filter(User.username.ilike(contains, escape='\\'))
+
+    if _is_postgresql():
+        by_username = by_username.order_by(User.username.op('<->')(term))
+
+        document = db.literal_column(USER_PROFILE_DOCUMENT)
+        query = db.func.plainto_tsquery('english', term)
+        by_profile = (User.query
+                      .filter(document.op('@@')(query))
+                      .order_by(db.func.ts_rank(document, query).desc()))
+    else:
+        by_username = by_username.order_by(db.func.length(User.username),
+                                           User.username)
+        by_profile = (User.query
+                      .filter(db.or_(User.bio.ilike(contains, escape='\\'),
+                                     User.location.ilike(contains,
+                                                         escape='\\')))
+                      .order_by(User.id))
+
+    if viewer_id is not None:
+        not_blocked = Block.not_between(viewer_id, User.id)
+        by_username = by_username.filter(not_blocked)
+        by_profile = by_profile.filter(not_blocked)
+
+    users = by_username.limit(limit).all()
+    if len(users) < limit:
+        found = [user.id for user in users]
+        users.extend(by_profile
+                     .filter(User.id.notin_(found))
+                     .limit(limit - len(users))
+                     .all())
+
+    return users
+
+
+def autocomplete_usernames(prefix, limit=AUTOCOMPLETE_LIMIT):
+    """Usernames starting with `prefix`, alphabetically."""
+
+    prefix = prefix.strip()
+    if not prefix:
+        return []
+
+    rows = (db.session
+            .query(User.username)
+            .filter(User.username.like(f"{_escape_like(prefix)}%",
+                                       escape='\\'))
+            .order_by(User.username)
+            .limit(limit))
+
+    return [username for (username,) in rows]
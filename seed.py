@@ -1,19 +1,132 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+Streams each CSV into the database a batch at a time, so memory use stays
+flat however big the files are. On PostgreSQL each batch is sent with
+COPY; other databases get a multi-row INSERT per batch. Timelines are
+then built a batch of users at a time.
+
+    python seed.py                        # load generator/*.csv
+    python seed.py --data-dir big --batch-size 50000
+"""
+
+import argparse
+import csv
+import io
+import sys
+import time
+from itertools import islice
 
-from csv import DictReader
 from app import db, connect_db
-from models import User, Message, Follow
+from models import User, Message, Follow, TimelineEntry, recount_counters
+
+# (CSV file name, table) in load order: messages and follows refer to users.
+SEED_FILES = [
+    ('users.csv', User.__table__),
+    ('messages.csv', Message.__table__),
+    ('follows.csv', Follow.__table__),
+]
+
+
+def report(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def batches(reader, batch_size):
+    """Yield lists of up to `batch_size` rows from `reader`."""
+
+    while True:
+        batch = list(islice(reader, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def copy_batch(table, columns, rows):
+    """Send `rows` (lists of strings) to `table` with PostgreSQL COPY."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH CSV",
+        buffer)
+
+
+def insert_batch(table, columns, rows):
+    """Insert `rows` (lists of strings) into `table` with one executemany.
+
+    Uses a textual INSERT so the CSV strings go to the driver as they are,
+    like they would with COPY.
+    """
+
+    insert = db.text(
+        f"INSERT INTO {table.name} ({', '.join(columns)}) "
+        f"VALUES ({', '.join(':' + column for column in columns)})")
+    db.session.execute(insert, [dict(zip(columns, row)) for row in rows])
+
+
+def load_csv(path, table, batch_size):
+    """Stream the CSV at `path` into `table`, committing every batch."""
+
+    if db.engine.dialect.name == 'postgresql':
+        write_batch = copy_batch
+    else:
+        write_batch = insert_batch
+
+    loaded = 0
+    started = time.monotonic()
+
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        columns = next(reader)
+
+        for batch in batches(reader, batch_size):
+            write_batch(table, columns, batch)
+            db.session.commit()
+
+            loaded += len(batch)
+            rate = loaded / max(time.monotonic() - started, 1e-6)
+            report(f"{table.name}: {loaded:,} rows ({rate:,.0f} rows/s)")
+
+
+def build_timelines():
+    """Fill every timeline, committing after each batch of users, so no
+    single statement or transaction grows with the whole dataset."""
+
+    started = time.monotonic()
+    for last_id in TimelineEntry.rebuild_batches():
+        db.session.commit()
+        report(f"timelines: users up to {last_id:,} done")
+    report(f"timelines: done in {time.monotonic() - started:.1f}s")
+
+
+def timed(description, func):
+    report(f"{description}...")
+    started = time.monotonic()
+    func()
+    db.session.commit()
+    report(f"{description}: done in {time.monotonic() - started:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default='generator',
+                        help='directory holding users/messages/follows.csv')
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='rows sent to the database per batch')
+    args = parser.parse_args()
 
-db.drop_all()
-db.create_all()
+    db.drop_all()
+    db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    for file_name, table in SEED_FILES:
+        load_csv(f"{args.data_dir}/{file_name}", table, args.batch_size)
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    build_timelines()
+    timed("Counting messages, follows and likes", recount_counters)
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follow, DictReader(follows))
 
-db.session.commit()
+if __name__ == '__main__':
+    main()
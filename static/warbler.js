@@ -1,25 +1,68 @@
-$heartIcon = $('.fa-heart')
 $newWarbleBtn = $('#new-warble')
 $closeWarbleBtn = $('#close-warble')
 
-$heartIcon.on('click', async (evt) => {
-    let msgId = $(evt.target).data('msgid')
-    resp = await axios.post(`/messages/${msgId}/likes`)
-    toggleIcon($(evt.target))
+$(document).on('click', '.fa-heart', async (evt) => {
+    let $icon = $(evt.target)
+    let msgId = $icon.data('msgid')
+    let method = $icon.hasClass('far') ? 'put' : 'delete'
+    let resp = await axios({ method, url: `/api/messages/${msgId}/like` })
+    setIcon($icon, resp.data.liked)
 })
 
-function toggleIcon($icon) {
+function setIcon($icon, liked) {
+    if($icon.hasClass('fas') === liked) return;
+
     let numLikes = +$('.stat-likes').text();
     let path = window.location.pathname;
-    if($icon.hasClass('far')) {
-        $icon.removeClass('far')
-        $icon.addClass('fas')
-        if(path === '/') $('.stat-likes').text(numLikes + 1);
-    } else {
-        $icon.removeClass('fas');
-        $icon.addClass('far');
-        if(path === '/') $('.stat-likes').text(numLikes - 1);
-    }
+    $icon.toggleClass('fas', liked).toggleClass('far', !liked)
+    if(path === '/') $('.stat-likes').text(numLikes + (liked ? 1 : -1));
+}
+
+
+$(document).on('click', '.load-more', async (evt) => {
+    evt.preventDefault()
+    let $link = $(evt.target)
+    let resp = await axios.get($link.attr('href'), { params: { partial: 1 } })
+    let $page = $('<div>').html(resp.data)
+    let $nextLink = $page.find('.load-more').detach()
+    $($link.data('target')).append($page.children())
+    $link.replaceWith($nextLink)
+})
+
+
+// New follow requests arrive live on the notifications page
+let $followRequests = $('#messages[data-stream]')
+if ($followRequests.length && window.EventSource) {
+    let source = new EventSource($followRequests.data('stream'))
+    source.addEventListener('follow_request', (evt) => {
+        $('#no-notifications').remove()
+        $('#bulk-request-actions').removeClass('d-none')
+        $followRequests.append(followRequestItem(JSON.parse(evt.data)))
+    })
+    source.addEventListener('reload', () => window.location.reload())
+}
+
+function followRequestItem(sender) {
+    let $item = $(`
+        <li class="list-group-item">
+          <div class="message-area d-flex justify-content-between w-100 align-items-center">
+            <label class="mb-0">
+              <input type="checkbox" name="sender_ids" value="${sender.id}"
+                     form="bulk-requests" class="mr-2">
+              <span class="username"></span>
+            </label>
+            <div>
+              <form method="POST" action="/requests/accept/${sender.id}" class="d-inline">
+                  <button class="btn btn-primary">Accept</button>
+              </form>
+              <form method="POST" action="/requests/delete/${sender.id}" class="d-inline">
+                  <button class="btn btn-danger">Delete</button>
+              </form>
+            </div>
+          </div>
+        </li>`)
+    $item.find('.username').text(`@${sender.username}`)
+    return $item
 }
 
 
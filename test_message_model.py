@@ -10,6 +10,10 @@ app.config['SQLALCHEMY_ECHO'] = False
 
 app.config['TESTING'] = True
 
+# Run queued jobs right away, so tests can check what they did
+
+app.config['JOBS_INLINE'] = True
+
 bcrypt = Bcrypt()
 db.drop_all()
 db.create_all()
@@ -84,3 +88,13 @@ class MessageModelTestCase(TestCase):
         db.session.commit()
         self.assertEqual(len(self.m1.likers), 1)
         self.assertEqual(len(self.u2.liked_messages), 1)
+
+    def test_timestamp_is_set_per_message(self):
+        """Does each message get the time it was created, not import time?"""
+        before = datetime.datetime.utcnow()
+        new_message = Message(text="test message 2", user_id=self.u1.id)
+        db.session.add(new_message)
+        db.session.commit()
+
+        self.assertGreaterEqual(new_message.timestamp, before)
+        self.assertGreater(new_message.timestamp, self.m1.timestamp)
@@ -6,9 +6,11 @@
 
 
 import os
+import re
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import (db, connect_db, Message, User, Like, TimelineEntry,
+                    trending)
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -31,6 +33,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run queued jobs right away, so tests can check what they did
+
+app.config['JOBS_INLINE'] = True
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -40,6 +46,8 @@ class MessageViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        TimelineEntry.query.delete()
+        Like.query.delete()
 
         self.client = app.test_client()
 
@@ -133,6 +141,124 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Access unauthorized.",html)
 
-    
+    def test_home_feed_pagination(self):
+        """Does the home feed come a page at a time with a working cursor?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            for i in range(25):
+                c.post("/messages/new", data={"text": f"warble {i}"})
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("warble 24", html)
+            self.assertNotIn("warble 4</p>", html)
+            self.assertIn("Load more", html)
+
+            next_url = re.search(r'href="([^"]+)" class="[^"]*load-more', html)
+            next_url = next_url.group(1).replace("&amp;", "&")
+
+            resp = c.get(next_url + "&partial=1")
+            html = resp.get_data(as_text=True)
+            self.assertIn("warble 4</p>", html)
+            self.assertIn("warble 0</p>", html)
+            self.assertNotIn("warble 24", html)
+            self.assertNotIn("Load more", html)
+            self.assertNotIn("<nav", html)
+
+    def test_message_visibility(self):
+        """Are messages of private users shown only to their followers?"""
+        user_id, user2_id = self.testuser.id, self.testuser2.id
+        msg = self.testuser2.post_message("followers only")
+        self.testuser2.is_private = True
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            resp = c.get(f"/messages/{msg_id}")
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn("ERROR 404",
+                          c.get("/messages/0").get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.get(f"/messages/{msg_id}")
+            self.assertEqual(resp.status_code, 302)
+
+            User.query.get(user_id).follow(User.query.get(user2_id))
+            db.session.commit()
+
+            resp = c.get(f"/messages/{msg_id}")
+            self.assertIn("followers only", resp.get_data(as_text=True))
+            self.assertIn("Unfollow", resp.get_data(as_text=True))
+
+    def test_like_api(self):
+        """Are likes toggled idempotently through the JSON API?"""
 
-        
+        message = Message(text="likeable", user_id=self.testuser2.id)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+        user_id, user2_id = self.testuser.id, self.testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            url = f"/api/messages/{message_id}/like"
+            for i in range(2):
+                resp = c.put(url)
+                self.assertEqual(resp.json, {"liked": True, "likes": 1})
+
+            self.assertEqual(Like.query.count(), 1)
+            self.assertEqual(User.query.get(user_id).liked_count, 1)
+
+            for i in range(2):
+                resp = c.delete(url)
+                self.assertEqual(resp.json, {"liked": False, "likes": 0})
+
+            self.assertEqual(Like.query.count(), 0)
+            self.assertEqual(Message.query.get(message_id).like_count, 0)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+            self.assertEqual(c.put(url).status_code, 403)
+
+    def test_trending_api(self):
+        """Are liked messages listed as trending, minus private ones?"""
+
+        trending.invalidate()
+        public = Message(text="everyone", user_id=self.testuser2.id)
+        hidden = Message(text="followers only", user_id=self.testuser2.id)
+        db.session.add_all([public, hidden])
+        db.session.commit()
+        public_id, hidden_id = public.id, hidden.id
+        user_id, user2_id = self.testuser.id, self.testuser2.id
+
+        with self.client as c:
+            self.assertEqual(c.get("/api/trending").json, {"messages": []})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.put(f"/api/messages/{public_id}/like")
+            c.put(f"/api/messages/{hidden_id}/like")
+
+            resp = c.get("/trending")
+            self.assertIn("everyone", resp.get_data(as_text=True))
+
+            User.query.get(user2_id).is_private = True
+            db.session.commit()
+
+            with c.session_transaction() as sess:
+                del sess[CURR_USER_KEY]
+            self.assertEqual(c.get("/api/trending").json, {"messages": []})
+
+            User.query.get(user2_id).is_private = False
+            db.session.commit()
+            messages = c.get("/api/trending?limit=1").json["messages"]
+            self.assertEqual(len(messages), 1)
+            self.assertEqual(messages[0]["user"]["id"], user2_id)
+            self.assertEqual(messages[0]["likes"], 1)
@@ -0,0 +1,118 @@
+"""Query plan tests: hot queries must be served by indexes."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follow, Like, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+
+db.create_all()
+
+
+class QueryPlanTestCase(TestCase):
+    """Check that the feed, follower and liker queries use index scans."""
+
+    def setUp(self):
+        db.session.rollback()
+
+        self.user = User(id=1, email="plan@test.com", username="plan",
+                         password="x")
+        self.message = Message(id=1, text="plan", user_id=1)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def plan(self, query):
+        """EXPLAIN `query` with table scans discouraged, as in a big table.
+
+        With only a few rows a planner would rightly prefer scanning the
+        whole table, which says nothing about behaviour at scale.
+        """
+
+        dialect = db.engine.dialect
+        sql = str(query.statement.compile(
+            dialect=dialect, compile_kwargs={"literal_binds": True}))
+
+        if dialect.name == 'postgresql':
+            db.session.execute(db.text("SET LOCAL enable_seqscan = off"))
+            rows = db.session.execute(db.text(f"EXPLAIN {sql}"))
+        else:
+            rows = db.session.execute(db.text(f"EXPLAIN QUERY PLAN {sql}"))
+
+        return "\n".join(str(value) for row in rows for value in row)
+
+    def assertUsesIndex(self, query, table, index=None):
+        """Is `table` read through an index rather than a full scan?
+
+        If `index` is given, it must be the one used: with table scans
+        off, a planner lacking the right index falls back to a full scan
+        of another (e.g. the primary key), which isn't a table scan either.
+        """
+
+        plan = self.plan(query)
+
+        if db.engine.dialect.name == 'postgresql':
+            self.assertNotIn(f"Seq Scan on {table}", plan)
+        else:
+            for line in plan.splitlines():
+                if line.startswith(f"SCAN {table}") or line == f"SCAN TABLE {table}":
+                    self.assertIn("INDEX", line, plan)
+
+        if index:
+            self.assertIn(index, plan)
+        else:
+            self.assertRegex(plan, r"(?i)index|primary key")
+
+    def test_home_feed_uses_timeline_index(self):
+        query = TimelineEntry.messages_for(self.user.id).limit(20)
+
+        self.assertUsesIndex(query, "timelines",
+                             "ix_timelines_user_id_timestamp")
+
+    def test_profile_messages_use_user_timestamp_index(self):
+        query = (Message
+                 .query
+                 .filter(Message.user_id == self.user.id)
+                 .order_by(Message.timestamp.desc(), Message.id.desc())
+                 .limit(20))
+
+        self.assertUsesIndex(query, "messages",
+                             "ix_messages_user_id_timestamp")
+
+    def test_followers_use_index(self):
+        query = User.query.with_parent(self.user, "followers")
+
+        self.assertUsesIndex(query, "follows")
+
+    def test_following_uses_reverse_index(self):
+        query = User.query.with_parent(self.user, "following")
+
+        self.assertUsesIndex(query, "follows", "ix_follows_follower_followee")
+
+    def test_followers_of_followers_use_indexes(self):
+        followers = db.session.query(Follow.follower).filter(
+            Follow.followee == self.user.id)
+        query = db.session.query(Follow.follower).filter(
+            Follow.followee.in_(followers))
+
+        self.assertUsesIndex(query, "follows")
+
+    def test_likers_use_reverse_index(self):
+        query = User.query.with_parent(self.message, "likers")
+
+        self.assertUsesIndex(query, "likes", "ix_likes_message_id_user_id")
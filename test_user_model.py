@@ -6,9 +6,13 @@
 
 
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, User, Message, Follow
+from models import (db, User, Message, Follow, Like, Block, Request,
+                    TimelineEntry, Job, jobs, follow_graph, blocks_index, trending,
+                    recount_counters, password_hasher)
+from passwords import PasswordHasher, PasswordHasherBusy
 from sqlalchemy.exc import IntegrityError
 from flask_bcrypt import Bcrypt
 
@@ -28,6 +32,11 @@ from app import app
 # and create fresh new clean test data
 
 db.create_all()
+
+# Run queued jobs right away, so tests can check what they did
+
+app.config['JOBS_INLINE'] = True
+
 bcrypt = Bcrypt()
 
 class UserModelTestCase(TestCase):
@@ -40,6 +49,11 @@ class UserModelTestCase(TestCase):
         User.query.delete()
         Message.query.delete()
         Follow.query.delete()
+        Block.query.delete()
+        Request.query.delete()
+        blocks_index.clear()
+        TimelineEntry.query.delete()
+        Job.query.delete()
 
         u1 = User(
             email="test@test.com",
@@ -98,6 +112,21 @@ class UserModelTestCase(TestCase):
         self.assertEqual(self.u1.is_followed_by(self.u2), False)
 
 
+    def test_load_relations(self):
+        """Do preloaded relation sets agree with the EXISTS checks?"""
+        db.session.add(Follow(followee=self.u2.id, follower=self.u1.id))
+        db.session.add(Block(blocker=self.u2.id, blockee=self.u1.id))
+        db.session.commit()
+
+        self.u1.load_relations()
+
+        self.assertTrue(self.u1.is_following(self.u2))
+        self.assertTrue(self.u1.is_blocked(self.u2))
+        self.assertFalse(self.u1.is_blocking(self.u2))
+        self.assertFalse(self.u1.is_pending_follow(self.u2))
+        self.assertTrue(self.u2.is_blocking(self.u1))
+        self.assertTrue(self.u2.is_followed_by(self.u1))
+
     def test_signup(self):
         """successfully signs a user up"""
         response = User.signup("user3","user@hotmail.com,","pword", "google.com", False)
@@ -141,14 +170,375 @@ class UserModelTestCase(TestCase):
 
         self.assertFalse(bad_username)
 
+    def test_authenticate_rehashes_on_cost_change(self):
+        """Is a hash made with an old work factor upgraded on login?"""
+        rounds = password_hasher.rounds
+        password_hasher.rounds = 4
+        try:
+            user = User.authenticate(self.u1.username, "HASHED PASSWORD")
+            db.session.commit()
 
-    
+            self.assertTrue(user.password.startswith("$2b$04$"))
+            self.assertFalse(password_hasher.needs_rehash(user.password))
+            self.assertIsInstance(
+                User.authenticate(self.u1.username, "HASHED PASSWORD"), User)
+        finally:
+            password_hasher.rounds = rounds
+
+    def test_password_hasher_backpressure(self):
+        """Are hashes refused once every slot is taken?"""
+        hasher = PasswordHasher(bcrypt, rounds=4, workers=1, queue_size=0,
+                                wait=0)
+        hasher._slots.acquire()
+
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.hash("password")
+
+        hasher._slots.release()
+        self.assertTrue(hasher.check(hasher.hash("password"), "password"))
+
+    def test_timeline_fan_out(self):
+        """Are new messages delivered to followers and purged on unfollow?"""
+        db.session.add(Follow(followee=self.u2.id, follower=self.u1.id))
+        msg = Message(text="hello followers", user_id=self.u2.id)
+        db.session.add(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
+        db.session.commit()
 
+        self.assertEqual(TimelineEntry.messages_for(self.u1.id).all(), [msg])
+        self.assertEqual(TimelineEntry.messages_for(self.u2.id).all(), [msg])
 
+        TimelineEntry.purge(self.u1.id, self.u2.id)
+        db.session.commit()
 
+        self.assertEqual(TimelineEntry.messages_for(self.u1.id).all(), [])
 
+    def test_timeline_backfill_and_rebuild(self):
+        """Does following or rebuilding fill the timeline with old messages?"""
+        msg = Message(text="old message", user_id=self.u2.id)
+        db.session.add(msg)
+        db.session.add(Follow(followee=self.u2.id, follower=self.u1.id))
+        db.session.flush()
+        TimelineEntry.backfill(self.u1.id, self.u2.id)
+        TimelineEntry.backfill(self.u1.id, self.u2.id)
+        db.session.commit()
 
-        
+        self.assertEqual(TimelineEntry.messages_for(self.u1.id).all(), [msg])
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        self.assertEqual(TimelineEntry.messages_for(self.u1.id).all(), [msg])
+        self.assertEqual(TimelineEntry.messages_for(self.u2.id).all(), [msg])
+
+    def test_timeline_rebuild_in_batches(self):
+        """Do batches of users rebuild the same timelines as one pass?"""
+        self.u1.follow(self.u2)
+        msg1 = self.u1.post_message("from u1")
+        msg2 = self.u2.post_message("from u2")
+        db.session.commit()
+        u1_id, u2_id = self.u1.id, self.u2.id
+
+        TimelineEntry.query.delete()
+        done = []
+        for last_id in TimelineEntry.rebuild_batches(batch_size=1):
+            db.session.commit()
+            done.append(last_id)
+
+        self.assertEqual(done, list(range(1, max(u1_id, u2_id) + 1)))
+        self.assertEqual(TimelineEntry.messages_for(u1_id).all(), [msg2, msg1])
+        self.assertEqual(TimelineEntry.messages_for(u2_id).all(), [msg2])
+
+    def test_counters(self):
+        """Do follow, post and like keep the counters in step?"""
+        self.u1.follow(self.u2)
+        msg = self.u2.post_message("count me")
+        self.u1.like(msg)
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u1.liked_count, 1)
+        self.assertEqual(self.u2.follower_count, 1)
+        self.assertEqual(self.u2.message_count, 1)
+        self.assertEqual(msg.like_count, 1)
+
+        self.u2.block(self.u1)
+        msg.destroy()
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual(self.u1.following_count, 0)
+        self.assertEqual(self.u1.liked_count, 0)
+        self.assertEqual(self.u2.follower_count, 0)
+        self.assertEqual(self.u2.message_count, 0)
+
+    def test_recount_counters(self):
+        """Does recounting fix counters that have drifted?"""
+        db.session.add(Follow(followee=self.u2.id, follower=self.u1.id))
+        db.session.add(Message(text="uncounted", user_id=self.u2.id))
+        db.session.commit()
+
+        recount_counters()
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u2.follower_count, 1)
+        self.assertEqual(self.u2.message_count, 1)
+
+    def test_queued_jobs(self):
+        """Are side effects queued once, run by the worker and retried?"""
+        self.u1.follow(self.u2)
+        db.session.commit()
+
+        app.config['JOBS_INLINE'] = False
+        try:
+            msg = self.u2.post_message("queued")
+            jobs.enqueue('deliver_message', key=f"deliver_message:{msg.id}",
+                         message_id=msg.id)
+            self.u1.unfollow(self.u2)
+            self.u1.follow(self.u2)
+            db.session.commit()
+
+            self.assertEqual(Job.query.count(), 2)
+            self.assertEqual(TimelineEntry.messages_for(self.u2.id).all(), [msg])
 
+            self.assertEqual(jobs.run_pending(), 2)
+            self.assertEqual(Job.query.count(), 0)
+            # the purge was skipped, since u1 follows u2 again
+            self.assertEqual(TimelineEntry.messages_for(self.u1.id).all(), [msg])
 
+            jobs.handler('broken')(lambda: 1 / 0)
+            jobs.enqueue('broken')
+            db.session.commit()
+
+            self.assertEqual(jobs.run_pending(), 1)
+            job = Job.query.one()
+            self.assertEqual((job.status, job.attempts), ('pending', 1))
+            self.assertIn("ZeroDivisionError", job.last_error)
+            # not due again until the retry delay has passed
+            self.assertEqual(jobs.run_pending(), 0)
+        finally:
+            app.config['JOBS_INLINE'] = True
+            jobs.handlers.pop('broken', None)
+
+    def test_follow_graph(self):
+        """Does the follow graph find mutuals and suggestions, and keep up?"""
+        u3 = User.signup("testuser3", "test3@test.com", "password", None, False)
+        db.session.add(u3)
+        db.session.commit()
+        u1_id, u2_id, u3_id = self.u1.id, self.u2.id, u3.id
+
+        self.u1.follow(self.u2)
+        self.u2.follow(self.u1)
+        self.u2.follow(u3)
+        db.session.commit()
+        follow_graph.build()
+
+        self.assertEqual(follow_graph.mutuals(u1_id), {u2_id})
+        self.assertEqual(follow_graph.suggestions(u1_id), [(u3_id, [u2_id])])
+        self.assertEqual([(user.id, [f.id for f in followed_by], count)
+                          for user, followed_by, count
+                          in self.u1.suggested_follows()],
+                         [(u3_id, [u2_id], 1)])
+
+        # changes show up once committed, without a rebuild
+        self.u1.follow(u3)
+        self.u1.unfollow(self.u2)
+        self.assertEqual(follow_graph.following(u1_id), {u2_id})
+        db.session.commit()
+        self.assertEqual(follow_graph.following(u1_id), {u3_id})
+        self.assertEqual(follow_graph.mutuals(u1_id), set())
+        self.assertEqual(follow_graph.followed_by_following(u2_id, u3_id),
+                         {u1_id})
+
+        # rolled back changes never do
+        self.u1.follow(self.u2)
+        db.session.rollback()
+        self.assertEqual(follow_graph.following(u1_id), {u3_id})
+
+    def test_follow_graph_refreshes_in_background(self):
+        """Does a stale follow graph keep answering while it's rebuilt?"""
+        u1_id, u2_id = self.u1.id, self.u2.id
+        follow_graph.build()
+
+        # a follow made by another process: only a rebuild finds it
+        db.session.add(Follow(follower=u1_id, followee=u2_id))
+        db.session.commit()
+
+        follow_graph.max_age = 0
+        try:
+            with follow_graph._building:
+                self.assertEqual(follow_graph.following(u1_id), set())
+                refresher = follow_graph._refresher
+            refresher.join()
+        finally:
+            follow_graph.max_age = app.config['GRAPH_MAX_AGE']
+
+        self.assertEqual(follow_graph.following(u1_id), {u2_id})
+
+    def test_bulk_follow_requests(self):
+        """Are follow requests accepted and declined in bulk?"""
+        u3 = User.signup("testuser3", "test3@test.com", "password", None, False)
+        u4 = User.signup("testuser4", "test4@test.com", "password", None, False)
+        db.session.add_all([u3, u4])
+        db.session.commit()
+        self.u2.is_private = True
+        msg = self.u2.post_message("for followers")
+        self.u1.follow(self.u2)
+        for user in (self.u1, u3, u4):
+            user.request_follow(self.u2)
+        db.session.commit()
+        follow_graph.build()
+
+        self.assertEqual(self.u2.decline_follow_requests([u4.id]), 1)
+        accepted = self.u2.accept_follow_requests()
+        db.session.commit()
+        db.session.expire_all()
+
+        # u1 already followed, so only u3 is new
+        self.assertEqual(accepted, [u3.id])
+        self.assertEqual(Request.query.count(), 0)
+        self.assertEqual(self.u2.follower_count, 2)
+        self.assertEqual(u3.following_count, 1)
+        self.assertEqual(u4.following_count, 0)
+        self.assertTrue(u3.is_following(self.u2))
+        self.assertEqual(TimelineEntry.messages_for(u3.id).all(), [msg])
+        self.assertEqual(follow_graph.followers(self.u2.id), {self.u1.id, u3.id})
+
+    def test_deleted_sender_requests_not_accepted(self):
+        """Are a deleted account's follow requests dropped, not accepted?"""
+        u3 = User.signup("testuser3", "test3@test.com", "password", None, False)
+        db.session.add(u3)
+        self.u2.is_private = True
+        db.session.commit()
+        self.u1.request_follow(self.u2)
+        u3.request_follow(self.u2)
+        db.session.commit()
+        u1_id, u2_id, u3_id = self.u1.id, self.u2.id, u3.id
+
+        app.config['JOBS_INLINE'] = False
+        try:
+            self.u1.schedule_deletion()
+            db.session.commit()
+            self.assertEqual(Request.query.filter_by(sender=u1_id).count(), 0)
+
+            # a sender marked deleted whose requests are still there
+            User.query.filter_by(id=u3_id).update(
+                {"deleted_at": datetime.utcnow()})
+            db.session.commit()
+
+            self.assertEqual(self.u2.accept_follow_requests(), [])
+            db.session.commit()
+            jobs.run_pending()
+        finally:
+            app.config['JOBS_INLINE'] = True
+
+        db.session.expire_all()
+        self.assertEqual(User.query.get(u2_id).follower_count, 0)
+        self.assertEqual(Follow.query.filter_by(followee=u2_id).count(), 0)
+
+    def test_soft_delete_and_purge(self):
+        """Is a deleted account hidden at once and purged by the job?"""
+        self.u1.follow(self.u2)
+        msg = self.u2.post_message("soon gone")
+        self.u1.like(msg)
+        db.session.commit()
+        u1_id, u2_id = self.u1.id, self.u2.id
+
+        app.config['JOBS_INLINE'] = False
+        try:
+            self.u2.schedule_deletion()
+            db.session.commit()
+            db.session.expire_all()
+
+            self.assertIsNone(User.query.filter_by(id=u2_id).first())
+            self.assertEqual(Message.query.all(), [])
+            self.assertEqual(TimelineEntry.messages_for(u1_id).all(), [])
+            self.assertEqual(self.u1.following_count, 0)
+            self.assertEqual(self.u1.liked_count, 0)
+            self.assertIsNotNone(User.query
+                                 .execution_options(include_deleted=True)
+                                 .filter_by(id=u2_id)
+                                 .first())
+
+            self.assertEqual(jobs.run_pending(), 2)
+        finally:
+            app.config['JOBS_INLINE'] = True
+
+        everything = Message.query.execution_options(include_deleted=True)
+        self.assertEqual(everything.all(), [])
+        self.assertEqual(Follow.query.count(), 0)
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(TimelineEntry.query.count(), 0)
+        self.assertEqual(User.query
+                         .execution_options(include_deleted=True)
+                         .count(), 1)
+
+    def test_trending(self):
+        """Are messages ranked by recent likes, and kept up on commit?"""
+        Like.query.delete()
+        u3 = User.signup("testuser3", "test3@test.com", "password", None, False)
+        db.session.add(u3)
+        old = Message(text="old", user_id=self.u1.id)
+        new = Message(text="new", user_id=self.u1.id)
+        db.session.add_all([old, new])
+        db.session.commit()
+        old_id, new_id = old.id, new.id
+
+        # two likes from 3 half-lives ago lose to one from just now
+        long_ago = datetime.utcnow() - timedelta(hours=3)
+        db.session.add_all([
+            Like(user_id=self.u2.id, message_id=old_id, timestamp=long_ago),
+            Like(user_id=u3.id, message_id=old_id, timestamp=long_ago),
+        ])
+        self.u2.like(new)
+        db.session.commit()
+        trending.build()
+
+        top = trending.top(5)
+        self.assertEqual([message_id for message_id, _ in top],
+                         [new_id, old_id])
+        self.assertAlmostEqual(top[0][1], 1, places=2)
+        self.assertAlmostEqual(top[1][1], 0.25, places=2)
+
+        # likes show up once committed, without a rebuild
+        u3.like(new)
+        self.assertAlmostEqual(trending.top(1)[0][1], 1, places=2)
+        db.session.commit()
+        self.assertAlmostEqual(trending.top(1)[0][1], 2, places=2)
+
+        self.u2.unlike(Message.query.get(new_id))
+        u3.unlike(Message.query.get(new_id))
+        db.session.commit()
+        self.assertEqual([message_id for message_id, _ in trending.top(5)],
+                         [old_id])
+        self.assertEqual([message.id for message, _ in Message.trending(5)],
+                         [old_id])
+
+    def test_trending_refreshes_in_background(self):
+        """Do stale trending scores keep answering while they're rebuilt?"""
+        Like.query.delete()
+        msg = Message(text="liked elsewhere", user_id=self.u1.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id, u2_id = msg.id, self.u2.id
+        trending.build()
+
+        # a like made by another process: only a rebuild finds it
+        db.session.add(Like(user_id=u2_id, message_id=msg_id))
+        db.session.commit()
 
+        trending.max_age = 0
+        try:
+            with trending._building:
+                self.assertEqual(trending.top(5), [])
+                refresher = trending._refresher
+            refresher.join()
+        finally:
+            trending.max_age = app.config['TRENDING_MAX_AGE']
+
+        self.assertEqual([message_id for message_id, _ in trending.top(5)],
+                         [msg_id])
@@ -6,12 +6,16 @@
 
 
 import os
+import re
+from datetime import datetime
 from unittest import TestCase
 from flask import session
 
-from models import db, connect_db, Message, User
+from models import (db, connect_db, Message, User, TimelineEntry, Follow,
+                    Block, Request, blocks_index)
 from sqlalchemy.exc import IntegrityError, PendingRollbackError
 from sqlalchemy import exc
+from sqlalchemy.engine import make_url
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,9 +24,16 @@ from sqlalchemy import exc
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
+# A second database standing in for a read replica; the replica test is
+# skipped if it doesn't exist.
+REPLICA_DATABASE_URL = os.environ.get(
+    'REPLICA_TEST_DATABASE_URL', "postgresql:///warbler_test_replica")
+
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from notifications import notifications
+from search import search_users
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -34,6 +45,10 @@ db.create_all()
 app.config['TESTING'] = True
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run queued jobs right away, so tests can check what they did
+
+app.config['JOBS_INLINE'] = True
+
 
 class UserViewTestCase(TestCase):
     """Test views for user."""
@@ -44,6 +59,11 @@ class UserViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        TimelineEntry.query.delete()
+        Follow.query.delete()
+        Block.query.delete()
+        Request.query.delete()
+        blocks_index.clear()
 
         self.client = app.test_client()
 
@@ -153,6 +173,370 @@ class UserViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
             self.assertIn("ERROR 404",html)
     
+    def test_profile_edit_refreshes_session_user(self):
+        """Is the cached session user dropped when the profile changes?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get("/users")
+            resp = c.post(f"/users/{self.testuser.id}/profile", data={
+                "username": "renamed",
+                "email": "test@test.com",
+                "password": "testuser",
+            })
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.get("/users")
+            html = resp.get_data(as_text=True)
+            self.assertIn('alt="renamed"', html)
+
+    def test_deleted_session_user_is_logged_out(self):
+        """Is a session user deleted elsewhere, while their row is still
+        cached here, logged out rather than failing the request?"""
+        user_id = self.testuser.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.get("/users")
+
+            # as another process would: the cached row here is now stale
+            (User.query
+             .filter(User.id == user_id)
+             .update({"deleted_at": datetime.utcnow()},
+                     synchronize_session=False))
+            db.session.commit()
+
+            resp = c.get("/")
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn("/login", resp.location)
+            self.assertNotIn(CURR_USER_KEY, session)
+
+    def test_schedule_deletion_forgets_session_user(self):
+        """Is the session user logged out as soon as the account is
+        deleted, without waiting for the cached row to expire?"""
+        user_id = self.testuser.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.get("/users")
+
+            User.query.get(user_id).schedule_deletion()
+            db.session.commit()
+
+            resp = c.get("/users")
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn(CURR_USER_KEY, session)
+
+    def test_user_cards_are_cached_per_profile_version(self):
+        """Are cached cards reused across viewers and redrawn after edits?"""
+        fragment_cache = app.jinja_env.fragment_cache
+        fragment_cache.clear()
+        self.testuser.follow(self.testuser2)
+        db.session.commit()
+        user_id, user2_id = self.testuser.id, self.testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn("@testuser2", html)
+            self.assertIn(f'action="/users/stop-following/{user2_id}"', html)
+            cached = len(fragment_cache)
+
+            # another viewer reuses the cards but gets their own buttons
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+            html = c.get("/users").get_data(as_text=True)
+            self.assertEqual(len(fragment_cache), cached)
+            self.assertNotIn("/users/stop-following/", html)
+
+            c.post(f"/users/{user2_id}/profile", data={
+                "username": "renamed2",
+                "email": "test2@test.com",
+                "password": "testuser2",
+            })
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn("@renamed2", html)
+            self.assertNotIn("@testuser2", html)
+
+    def test_profile_conditional_get(self):
+        """Is an unchanged profile answered with 304, and a changed one not?"""
+        user_id, user2_id = self.testuser.id, self.testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.get(f"/users/{user2_id}")
+            etag = resp.headers["ETag"]
+            self.assertTrue(etag.startswith('W/'))
+            self.assertIn("no-cache", resp.headers["Cache-Control"])
+
+            resp = c.get(f"/users/{user2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            # a new message changes the page, though it isn't loaded to
+            # check the ETag
+            User.query.get(user2_id).post_message("new on the profile")
+            db.session.commit()
+            resp = c.get(f"/users/{user2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("new on the profile", resp.get_data(as_text=True))
+
+            c.post(f"/users/follow/{user2_id}", headers={"Referer": "/"})
+            resp = c.get(f"/users/{user2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unfollow", resp.get_data(as_text=True))
+
+            # liking one message and unliking another keeps the viewer's
+            # like count, but not the hearts on the page
+            author = User.query.get(user2_id)
+            liked = author.post_message("liked first")
+            other = author.post_message("liked second")
+            db.session.commit()
+            liked_id, other_id = liked.id, other.id
+            c.put(f"/api/messages/{liked_id}/like")
+            etag = c.get(f"/users/{user2_id}").headers["ETag"]
+
+            c.delete(f"/api/messages/{liked_id}/like")
+            c.put(f"/api/messages/{other_id}/like")
+            resp = c.get(f"/users/{user2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
+            # likes elsewhere don't change this page
+            etag = resp.headers["ETag"]
+            u3 = User.signup("testuser3", "test3@test.com", "testuser",
+                             None, False)
+            db.session.add(u3)
+            db.session.flush()
+            elsewhere = u3.post_message("on another profile")
+            db.session.commit()
+            c.put(f"/api/messages/{elsewhere.id}/like")
+            resp = c.get(f"/users/{user2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+    def test_static_files_are_fingerprinted(self):
+        """Are static URLs versioned and served as immutable?"""
+        with self.client as c:
+            html = c.get("/login").get_data(as_text=True)
+            url = re.search(r'src="(/static/warbler\.js\?v=\w+)"', html).group(1)
+
+            resp = c.get(url)
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+            self.assertIn("no-store", c.get("/login").headers["Cache-Control"])
+
+    def test_read_replica_routing(self):
+        """Do marked views read from the replica, except right after a write?"""
+        user_id = self.testuser.id
+        app.config['SQLALCHEMY_BINDS'] = {'replica': REPLICA_DATABASE_URL}
+        try:
+            replica = db.get_engine(app, bind='replica')
+            try:
+                replica.connect().close()
+            except exc.OperationalError:
+                self.skipTest(f"no replica database at {REPLICA_DATABASE_URL}")
+            db.Model.metadata.drop_all(replica)
+            db.Model.metadata.create_all(replica)
+            # a replica lagging behind: it has the users, then one more
+            users = db.session.execute(User.__table__.select()).fetchall()
+            replica.execute(User.__table__.insert(),
+                            [dict(user._mapping) for user in users])
+            replica.execute(User.__table__.insert().values(
+                id=999, username="onlyonreplica", email="r@test.com",
+                password="x"))
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+
+                html = c.get("/users").get_data(as_text=True)
+                self.assertIn("@onlyonreplica", html)
+
+                c.post("/messages/new", data={"text": "fresh"})
+                html = c.get("/users").get_data(as_text=True)
+                self.assertNotIn("@onlyonreplica", html)
+        finally:
+            del app.config['SQLALCHEMY_BINDS']
+            db.session.remove()
+
+    def test_pool_options_per_engine(self):
+        """Are pool options only given to engines that pool?"""
+        _, options = db.apply_driver_hacks(
+            app, make_url("postgresql:///warbler_test_replica"), {})
+        self.assertEqual(options["pool_size"],
+                         app.config["DATABASE_POOL_OPTIONS"]["pool_size"])
+
+        _, options = db.apply_driver_hacks(
+            app, make_url("sqlite:////tmp/warbler_replica.db"), {})
+        self.assertNotIn("pool_size", options)
+
+    def test_search_users(self):
+        """Does search match usernames and bios, as HTML and JSON?"""
+        self.testuser2.bio = "birdwatcher from Portland"
+        db.session.commit()
+
+        with self.client as c:
+            html = c.get("/users?q=user2").get_data(as_text=True)
+            self.assertIn("@testuser2", html)
+            self.assertNotIn("@testuser<", html)
+
+            resp = c.get("/api/users?q=birdwatcher")
+            self.assertEqual(resp.json["users"][0]["username"], "testuser2")
+
+            resp = c.get("/api/users/autocomplete?q=test")
+            self.assertEqual(resp.json["usernames"], ["testuser", "testuser2"])
+
+    def test_blocked_users_are_hidden(self):
+        """Are users who block each other left out of pages and feeds?"""
+        user_id, user2_id = self.testuser.id, self.testuser2.id
+        self.testuser2.follow(self.testuser)
+        self.testuser.post_message("before the block")
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+
+            self.assertIn("before the block", c.get("/").get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.post(f"/users/block/{user2_id}")
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertNotIn("@testuser2", html)
+            html = c.get("/users?q=testuser").get_data(as_text=True)
+            self.assertNotIn("@testuser2", html)
+
+            # left out before the limit, so the page isn't short
+            u3 = User.signup("testuser3", "test3@test.com", "testuser",
+                             None, False)
+            db.session.add(u3)
+            db.session.commit()
+            self.assertEqual(
+                [user.username
+                 for user in search_users("testuser", limit=2,
+                                          viewer_id=user_id)],
+                ["testuser", "testuser3"])
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+
+            self.assertNotIn("before the block",
+                             c.get("/").get_data(as_text=True))
+            resp = c.get(f"/users/{user_id}")
+            self.assertEqual(resp.status_code, 302)
+
+    def test_follow_request_notifications(self):
+        """Do follow requests reach the recipient's open stream?"""
+        user_id, user2_id = self.testuser.id, self.testuser2.id
+        self.testuser2.is_private = True
+        db.session.commit()
+
+        stream = app.test_client()
+        with stream.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user2_id
+        resp = stream.get("/notifications/stream", buffered=False)
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        events = iter(resp.response)
+        self.assertIn("retry:", next(events).decode())
+        self.assertEqual(notifications.connections, 1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.post(f"/users/follow/{user2_id}",
+                   headers={"Referer": f"/users/{user2_id}"})
+
+        event = next(events).decode()
+        self.assertIn("event: follow_request", event)
+        self.assertIn('"username": "testuser"', event)
+
+        resp.close()
+        self.assertEqual(notifications.connections, 0)
+
+    def test_bulk_follow_requests(self):
+        """Can all pending follow requests be accepted at once?"""
+        user_id, user2_id = self.testuser.id, self.testuser2.id
+        self.testuser2.request_follow(self.testuser)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            html = c.get("/notifications").get_data(as_text=True)
+            self.assertIn('name="sender_ids"', html)
+
+            resp = c.post("/requests?all=1", data={"action": "accept"},
+                          follow_redirects=True)
+            self.assertIn("Accepted 1 follow request(s).",
+                          resp.get_data(as_text=True))
+
+            # kept, hidden, for requests that arrive over the stream
+            html = c.get("/notifications").get_data(as_text=True)
+            self.assertIn('id="bulk-requests"', html)
+
+        self.assertTrue(User.query.get(user2_id)
+                        .is_following(User.query.get(user_id)))
+
+    def test_request_metrics(self):
+        """Are query counts sent as Server-Timing and totalled on /metrics?"""
+        with self.client as c:
+            resp = c.get("/users")
+            self.assertRegex(resp.headers["Server-Timing"],
+                             r'db;dur=[\d.]+;desc="\d+ queries"')
+
+            # off by default
+            html = c.get("/metrics").get_data(as_text=True)
+            self.assertNotIn("warbler_sql_queries_total", html)
+
+            app.config['METRICS_ENABLED'] = True
+            try:
+                html = c.get("/metrics").get_data(as_text=True)
+                self.assertRegex(html,
+                                 r'warbler_sql_queries_total\{route="list_users"\} \d+')
+
+                resp = c.get("/metrics",
+                             environ_base={"REMOTE_ADDR": "203.0.113.5"})
+                self.assertEqual(resp.status_code, 403)
+            finally:
+                app.config['METRICS_ENABLED'] = False
+
+    def test_metrics_token(self):
+        """With METRICS_TOKEN set, does /metrics need it from any host?"""
+        app.config['METRICS_ENABLED'] = True
+        app.config['METRICS_TOKEN'] = "scrape-me"
+        try:
+            with self.client as c:
+                resp = c.get("/metrics")
+                self.assertEqual(resp.status_code, 403)
+
+                resp = c.get("/metrics",
+                             headers={"Authorization": "Bearer wrong"})
+                self.assertEqual(resp.status_code, 403)
+
+                resp = c.get("/metrics",
+                             headers={"Authorization": "Bearer scrape-me"},
+                             environ_base={"REMOTE_ADDR": "203.0.113.5"})
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("warbler_requests_total",
+                              resp.get_data(as_text=True))
+        finally:
+            app.config['METRICS_ENABLED'] = False
+            app.config['METRICS_TOKEN'] = None
+
     def test_user_logout(self):
         with self.client as c:
             with c.session_transaction() as sess:
@@ -0,0 +1,231 @@
+"""Trending messages: the most liked lately, kept in memory.
+
+Each like adds a weight to its message's score, and the weight grows
+exponentially with the time the like was made (forward decay):
+
+    weight = 2 ** ((liked_at - landmark) / half_life)
+
+A like made one half-life later counts twice as much, which has the same
+effect on the ranking as halving every older like. But old scores never
+need decaying, so a like only touches its own message's score. Dividing
+a score by the weight of "now" gives the number of likes it has, each
+decayed by its age.
+
+Scores are kept for at most TRENDING_SIZE messages, in a list sorted by
+score, so the top k are simply its last k entries. When it's full, the
+message with the lowest score is dropped.
+
+Like the follow graph (graph.py), each process keeps its own copy. A
+like or unlike is applied once its transaction commits (see record()),
+so reads never rescan the likes table. The whole thing is rebuilt from
+the likes of the last WINDOW_HALF_LIVES half-lives every TRENDING_MAX_AGE
+seconds, which picks up likes made in other processes and resets the
+landmark before the weights get large. As with the follow graph, the
+rebuild runs in a background thread and top() keeps answering from the
+old scores until the new ones are swapped in.
+"""
+
+import heapq
+import time
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from threading import Lock, RLock, Thread
+
+from sqlalchemy import event, select
+
+# Likes older than this many half-lives weigh under 1/256 and are ignored.
+WINDOW_HALF_LIVES = 8
+
+
+class Trending:
+    """Time-decayed like scores of the most liked recent messages."""
+
+    def __init__(self, db, model):
+        self.db = db
+        self.model = model
+        self.half_life = 3600
+        self.size = 10000
+        self.max_age = 60
+        self.logger = None
+        self._lock = RLock()
+        self._building = Lock()
+        self._scores = None
+        self._ranked = []
+        self._landmark = None
+        self._built_at = 0
+        self._refresher = None
+        # (cutoff, changes committed during a build), see _build()
+        self._journal = None
+
+    def init_app(self, app):
+        app.config.setdefault('TRENDING_HALF_LIFE', 3600)
+        app.config.setdefault('TRENDING_SIZE', 10000)
+        app.config.setdefault('TRENDING_MAX_AGE', 60)
+        self.half_life = app.config['TRENDING_HALF_LIFE']
+        self.size = app.config['TRENDING_SIZE']
+        self.max_age = app.config['TRENDING_MAX_AGE']
+        self.logger = app.logger
+
+        # apply a session's likes only once they're committed
+        session = self.db.session
+        if not event.contains(session, 'after_commit',
+                              self._apply_session_changes):
+            event.listen(session, 'after_commit', self._apply_session_changes)
+            event.listen(session, 'after_rollback', self._drop_session_changes)
+
+    def _weight(self, when):
+        return 2 ** ((when - self._landmark).total_seconds() / self.half_life)
+
+    # building and keeping up to date
+
+    def build(self):
+        """Score the messages liked in the last WINDOW_HALF_LIVES
+        half-lives and swap the scores in."""
+
+        with self._building:
+            self._build()
+
+    def _build(self):
+        # Reads on a connection of its own, without holding _lock, so
+        # top() carries on meanwhile. Caller must hold _building.
+        #
+        # Scores add up, so a like must be counted by the scan or by the
+        # journal, never both: the scan stops at `cutoff`, and only likes
+        # made from then on are replayed. (A like made just before it but
+        # committed after the scan started waits for the next rebuild.)
+        Like = self.model
+        cutoff = datetime.utcnow()
+        landmark = cutoff - timedelta(
+            seconds=WINDOW_HALF_LIVES * self.half_life)
+
+        with self._lock:
+            self._journal = (cutoff, [])
+        try:
+            with self.db.engine.connect() as connection:
+                likes = (connection
+                         .execution_options(stream_results=True)
+                         .execute(select(Like.message_id, Like.timestamp)
+                                  .where(Like.timestamp >= landmark,
+                                         Like.timestamp < cutoff)))
+
+                scores = {}
+                for message_id, liked_at in likes:
+                    weight = 2 ** ((liked_at - landmark).total_seconds()
+                                   / self.half_life)
+                    scores[message_id] = scores.get(message_id, 0) + weight
+        except Exception:
+            with self._lock:
+                self._journal = None
+            raise
+
+        top = heapq.nlargest(self.size, scores.items(),
+                             key=lambda item: item[1])
+
+        with self._lock:
+            (_, journal), self._journal = self._journal, None
+            self._landmark = landmark
+            self._scores = dict(top)
+            self._ranked = sorted((score, message_id)
+                                  for message_id, score in top)
+            for message_id, change, liked_at in journal:
+                if liked_at is not None and liked_at >= cutoff:
+                    self._apply(message_id, change, liked_at)
+            self._built_at = time.monotonic()
+
+    def invalidate(self):
+        """Rebuild from the database on next use."""
+
+        with self._lock:
+            self._scores = None
+
+    def _ensure_built(self):
+        if self._scores is None:
+            # nothing to serve yet, so this one has to wait
+            with self._building:
+                if self._scores is None:
+                    self._build()
+        elif time.monotonic() - self._built_at > self.max_age:
+            self._refresh_in_background()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = Thread(target=self._refresh,
+                                     name='trending-refresh', daemon=True)
+        self._refresher.start()
+
+    def _refresh(self):
+        try:
+            self.build()
+        except Exception:
+            if self.logger:
+                self.logger.exception("Rebuilding trending scores failed")
+            # try again after another TRENDING_MAX_AGE, not on every read
+            self._built_at = time.monotonic()
+        finally:
+            self._refresher = None
+
+    def record(self, session, message_id, change, liked_at):
+        """Note that the like of `message_id` made at `liked_at` was
+        added (change 1) or removed (change -1) in `session`'s transaction.
+
+        Applied when the transaction commits.
+        """
+
+        session.info.setdefault('trending_changes', []).append(
+            (message_id, change, liked_at))
+
+    def _apply_session_changes(self, session):
+        changes = session.info.pop('trending_changes', ())
+        with self._lock:
+            for message_id, change, liked_at in changes:
+                self._apply(message_id, change, liked_at)
+
+    def _drop_session_changes(self, session):
+        session.info.pop('trending_changes', None)
+
+    def _apply(self, message_id, change, liked_at):
+        if self._journal is not None:
+            self._journal[1].append((message_id, change, liked_at))
+        if self._scores is None:
+            return
+
+        # likes from before the landmark were never counted
+        if liked_at is None or liked_at < self._landmark:
+            return
+
+        old = self._scores.get(message_id)
+        if old is None and change < 0:
+            return
+
+        score = (old or 0) + change * self._weight(liked_at)
+
+        if old is not None:
+            del self._ranked[bisect_left(self._ranked, (old, message_id))]
+            del self._scores[message_id]
+
+        # every like counted weighs at least 1 (it's no older than the
+        # landmark), so anything less is rounding left by unlikes
+        if score < 0.5:
+            return
+        if len(self._ranked) >= self.size:
+            if score <= self._ranked[0][0]:
+                return
+            _, evicted = self._ranked.pop(0)
+            del self._scores[evicted]
+
+        self._scores[message_id] = score
+        insort(self._ranked, (score, message_id))
+
+    # queries
+
+    def top(self, limit=20):
+        """[(message id, decayed like count), ...] of the `limit` top
+        messages, best first."""
+
+        self._ensure_built()
+        with self._lock:
+            now = self._weight(datetime.utcnow())
+            return [(message_id, score / now)
+                    for score, message_id in self._ranked[:-limit - 1:-1]]
@@ -0,0 +1,106 @@
+"""Who may see a user's profile, follow lists, likes and messages.
+
+The profile, following, followers and likes pages and the single message
+page all need the same two things: the user whose content it is, and how
+the logged-in viewer relates to them. resolve_user() and resolve_message()
+load both in one query. The relationship flags come from EXISTS
+subqueries on the follows, requests and blocks primary keys.
+"""
+
+from flask import abort, g
+
+from models import db, Block, Follow, Message, Request, User
+
+
+class Visibility:
+    """A user, and how the viewer relates to them.
+
+    `viewer` is g.user (None when logged out); the flags say whether the
+    viewer follows, has requested to follow, blocks, or is blocked by
+    `user`.
+    """
+
+    def __init__(self, user, viewer, following=False, requested=False,
+                 blocking=False, blocked_by=False):
+        self.user = user
+        self.viewer = viewer
+        self.following = bool(following)
+        self.requested = bool(requested)
+        self.blocking = bool(blocking)
+        self.blocked_by = bool(blocked_by)
+
+        self.is_self = viewer is not None and viewer.id == user.id
+        self.is_admin = viewer is not None and viewer.is_admin
+
+    @property
+    def can_view(self):
+        """May the viewer see this user's messages, likes and follows?"""
+
+        if self.is_self or self.is_admin:
+            return True
+        if self.blocked_by:
+            return False
+        return self.following or not self.user.is_private
+
+    @property
+    def relations(self):
+        """The flags, for ETags of pages that show them."""
+
+        return (self.following, self.requested, self.blocking, self.blocked_by)
+
+
+def _relation_flags(viewer_id, user_id):
+    """EXISTS columns for the Visibility flags, in order."""
+
+    def exists(*criteria):
+        return db.exists().where(db.and_(*criteria))
+
+    return [
+        exists(Follow.follower == viewer_id, Follow.followee == user_id),
+        exists(Request.sender == viewer_id, Request.recipient == user_id),
+        exists(Block.blocker == viewer_id, Block.blockee == user_id),
+        exists(Block.blocker == user_id, Block.blockee == viewer_id),
+    ]
+
+
+def _resolve(query, user_column):
+    """Run `query` with the viewer's flags for `user_column` added.
+
+    Returns (the query's entity, its flags) or aborts with a 404.
+    """
+
+    if g.user:
+        query = query.add_columns(*_relation_flags(g.user.id, user_column))
+
+    row = query.first()
+    if row is None:
+        abort(404)
+
+    if not g.user:
+        return row, ()
+    return row[0], row[1:]
+
+
+def resolve_user(user_id):
+    """Load user `user_id` and how the viewer relates to them, in one
+    query. 404s if there's no such user."""
+
+    user, flags = _resolve(User.query.filter(User.id == user_id), User.id)
+    return Visibility(user, g.user, *flags)
+
+
+def resolve_message(message_id):
+    """Load message `message_id` with its author, and how the viewer
+    relates to the author, in one query. 404s if there's no such message.
+
+    Returns (message, visibility).
+    """
+
+    query = (Message
+             .query
+             .options(db.contains_eager(Message.user))
+             .join(Message.user)
+             .filter(Message.id == message_id))
+
+    message, flags = _resolve(query, Message.user_id)
+    return message, Visibility(message.user, g.user, *flags)
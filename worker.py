@@ -0,0 +1,43 @@
+"""Run queued jobs (see jobs.py).
+
+    python worker.py            # run jobs as they come in, until stopped
+    python worker.py --once     # run every job that's due, then exit
+"""
+
+import argparse
+import signal
+import time
+
+from app import app
+from models import jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--once', action='store_true',
+                        help='exit when no jobs are due')
+    parser.add_argument('--poll', type=float, default=1.0,
+                        help='seconds to wait when there are no jobs')
+    args = parser.parse_args()
+
+    stopping = False
+
+    def stop(signum, frame):
+        # finish the job in hand, then exit
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    with app.app_context():
+        while not stopping:
+            if jobs.run_next():
+                continue
+            if args.once:
+                break
+            time.sleep(args.poll)
+
+
+if __name__ == '__main__':
+    main()